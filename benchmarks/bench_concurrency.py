@@ -0,0 +1,141 @@
+"""
+Concurrency benchmark: sync WSGI workers versus the gevent serving mode
+
+Starts the service under gunicorn once per mode with the same number of
+processes, loads some Customers, then keeps a fixed number of clients
+reading single Customers and listing pages for a while and reports the
+throughput and latency of each mode. The Customer cache is turned off so
+that reads measure database round trips rather than cache hits.
+
+    DATABASE_URI=postgres://... python benchmarks/bench_concurrency.py --clients 200
+
+The cooperative mode only pays off when the database driver yields while it
+waits, which psycopg2 does in service.green. The sqlite3 driver blocks the
+whole process, so benchmark against Postgres.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import subprocess
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+MODES = {
+    "sync": ["--worker-class=sync", "--threads=1", "service:app"],
+    "gevent": ["--worker-class=gevent", "--worker-connections=2000", "service.green:app"],
+}
+
+
+def request(url, data=None, method="GET"):
+    """ Sends one request and returns the decoded JSON body """
+    headers = {"Content-Type": "application/json"} if data is not None else {}
+    body = json.dumps(data).encode() if data is not None else None
+    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    with urllib.request.urlopen(req, timeout=60) as resp:
+        return json.loads(resp.read() or b"null")
+
+
+def start_server(mode, port, workers):
+    """ Starts gunicorn in the given mode and waits until it answers """
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "--bind=127.0.0.1:{}".format(port),
+        "--workers={}".format(workers),
+        "--log-level=warning",
+    ] + MODES[mode]
+    # without the Customer cache every read reaches the database, which is
+    # the waiting the two modes handle differently
+    env = dict(os.environ, CUSTOMER_CACHE_SIZE="0")
+    server = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen("http://127.0.0.1:{}/stats/cache".format(port), timeout=1)
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start in {} mode".format(mode))
+
+
+def seed(base_url, count):
+    """ Replaces every Customer with count generated ones and returns their ids """
+    request(base_url + "/customers?confirm=true", method="DELETE")
+    customers = [
+        {
+            "firstname": "First{}".format(n), "lastname": "Last{}".format(n % 50),
+            "email_id": "c{}@example.com".format(n), "address": "{} Main St".format(n),
+            "phone_number": "555{:07d}".format(n), "card_number": "4000{:012d}".format(n),
+            "active": n % 3 != 0,
+        }
+        for n in range(count)
+    ]
+    results = request(base_url + "/customers/batch", data=customers, method="POST")
+    return [x["customer_id"] for x in results]
+
+
+def run_clients(base_url, customer_ids, clients, seconds):
+    """ Keeps clients busy for seconds and returns the latency of every request """
+
+    def client(_):
+        latencies = []
+        rnd = random.Random()
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            if rnd.random() < 0.8:
+                url = "{}/customers/{}".format(base_url, rnd.choice(customer_ids))
+            else:
+                url = "{}/customers?lastname=Last{}&limit=20".format(base_url, rnd.randrange(50))
+            start = time.perf_counter()
+            try:
+                request(url)
+            except (urllib.error.URLError, ConnectionError):
+                continue
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        return [x for latencies in pool.map(client, range(clients)) for x in latencies]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=100, help="concurrent clients")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each run")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn processes per mode")
+    parser.add_argument("--customers", type=int, default=1000, help="customers to load")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    print("{:>8} {:>10} {:>10} {:>10} {:>10}".format("mode", "requests", "req/s", "p50 ms", "p99 ms"))
+    for mode in args.modes:
+        server = start_server(mode, args.port, args.workers)
+        try:
+            customer_ids = seed(base_url, args.customers)
+            latencies = sorted(run_clients(base_url, customer_ids, args.clients, args.seconds))
+        finally:
+            server.terminate()
+            server.wait()
+        if not latencies:
+            print("{:>8} no successful requests".format(mode))
+            continue
+        print(
+            "{:>8} {:>10} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                mode,
+                len(latencies),
+                len(latencies) / args.seconds,
+                statistics.median(latencies) * 1000,
+                latencies[int(len(latencies) * 0.99) - 1] * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Startup benchmark: how long a new worker takes to serve its first request
+
+Each run starts a fresh interpreter, as a new gunicorn worker would without
+preloading, and times importing the service package, building the app, and
+answering a first GET /customers (which opens the first database connection
+and creates missing tables) and a second one.
+
+    DATABASE_URI=postgres://... python benchmarks/bench_startup.py --runs 20
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Runs in the child process and prints the timings in milliseconds
+CHILD = """
+import json, time
+start = time.perf_counter()
+import service
+imported = time.perf_counter()
+app = service.app
+created = time.perf_counter()
+client = app.test_client()
+first = client.get("/customers?limit=1")
+served = time.perf_counter()
+second = client.get("/customers?limit=1")
+again = time.perf_counter()
+assert first.status_code == 200 and second.status_code == 200, (first.status_code, second.status_code)
+print(json.dumps({
+    "import": (imported - start) * 1000,
+    "create_app": (created - imported) * 1000,
+    "first_request": (served - created) * 1000,
+    "second_request": (again - served) * 1000,
+    "import_to_first_request": (served - start) * 1000,
+}))
+"""
+
+
+def run_once(root):
+    """ Times one cold start in a new interpreter """
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=root, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10, help="cold starts to time")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [run_once(root) for _ in range(args.runs)]
+    print("{:>24} {:>10} {:>10} {:>10}".format("phase (ms)", "min", "median", "max"))
+    for phase in runs[0]:
+        values = [run[phase] for run in runs]
+        print(
+            "{:>24} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                phase, min(values), statistics.median(values), max(values)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -17,5 +17,67 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Optional read replica that serves read-only queries. A client that wrote
+# keeps reading from the primary for REPLICA_STICKY_SECONDS afterwards.
+DATABASE_REPLICA_URI = os.getenv("DATABASE_REPLICA_URI")
+SQLALCHEMY_BINDS = {"replica": DATABASE_REPLICA_URI} if DATABASE_REPLICA_URI else {}
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Create missing tables when the app starts. gunicorn.conf.py turns this off,
+# production applies the migrations with flask db-upgrade on every release.
+DB_AUTO_CREATE = os.getenv("DB_AUTO_CREATE", "true").lower() in ("true", "1", "yes")
+
+# Connection pool of each worker. Size it so that workers * (size + overflow)
+# stays below the max_connections of the database. SQLite does not pool.
+SQLALCHEMY_ENGINE_OPTIONS = {}
+if not DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "1", "yes"),
+    }
+
+# Keyset pagination for the list endpoint
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Number of rows fetched per round trip when streaming exports
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Number of results returned by GET /customers/search, by default and at most
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "20"))
+MAX_SEARCH_LIMIT = int(os.getenv("MAX_SEARCH_LIMIT", "100"))
+
+# Country calling code of phone numbers given without one, for lookups
+PHONE_COUNTRY_CODE = os.getenv("PHONE_COUNTRY_CODE", "1")
+
+# Largest payload accepted by POST /customers/batch and rows per INSERT
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "5000"))
+INSERT_CHUNK_SIZE = int(os.getenv("INSERT_CHUNK_SIZE", "500"))
+
+# Rows loaded per transaction by imports
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+
+# Read-through cache for single Customer lookups, set the size to 0 to disable it.
+# Every worker has its own cache so the TTL bounds how stale another worker may be.
+CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", "1024"))
+CUSTOMER_CACHE_TTL = float(os.getenv("CUSTOMER_CACHE_TTL", "5"))
+
+# Compression of API responses of at least COMPRESS_MIN_SIZE bytes
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+# Webhooks posted by flask webhooks-dispatch, WEBHOOK_URLS is comma separated
+WEBHOOK_URLS = os.getenv("WEBHOOK_URLS", "")
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "8"))
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "5"))
+WEBHOOK_BACKOFF = float(os.getenv("WEBHOOK_BACKOFF", "1"))
+WEBHOOK_MAX_BACKOFF = float(os.getenv("WEBHOOK_MAX_BACKOFF", "300"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "1"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
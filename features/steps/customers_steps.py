@@ -14,17 +14,15 @@ from compare import expect
 def step_impl(context):
     """ Delete all Customers and load new ones """
     headers = {'Content-Type': 'application/json'}
-    # list all of the customers and delete them one by one
-    context.resp = requests.get(context.base_url + '/customers', headers=headers)
+    # delete all of the customers in one request
+    context.resp = requests.delete(context.base_url + '/customers?confirm=true', headers=headers)
     expect(context.resp.status_code).to_equal(200)
-    for customer in context.resp.json():
-        context.resp = requests.delete(context.base_url + '/customers/' + str(customer["customer_id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
     
-    # load the database with new customers
-    create_url = context.base_url + '/customers'
+    # load the database with new customers in a single batch
+    create_url = context.base_url + '/customers/batch'
+    customers = []
     for row in context.table:
-        data = {
+        customers.append({
             #"customer_id": row["customer_id"],
             "firstname": row['firstname'],
             "lastname": row['lastname'],
@@ -33,7 +31,7 @@ def step_impl(context):
             "phone_number": row['phone_number'],
             "card_number": row['card_number'],
             "active": row['active'] in ['True', 'true', '1']
-            }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+            })
+    payload = json.dumps(customers)
+    context.resp = requests.post(create_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(201)
@@ -0,0 +1,77 @@
+"""
+Production gunicorn settings for the Customer service
+
+    gunicorn --config=gunicorn.conf.py service:app
+
+The app is loaded once in the master (preload_app) so workers fork with the
+code already imported, and every worker drops the database connections it
+inherited so no connection is shared across processes. Nothing here touches
+the database or writes into the package: migrations are a release step
+(flask db-upgrade) and the assets are precompressed at build time
+(bin/post_compile), so the server starts while the database is down and
+runs from a read only image.
+
+Every setting can be overridden from the environment:
+
+    WEB_CONCURRENCY     worker processes, default as many as DB_MAX_CONNECTIONS
+                        allows when each opens up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+    DB_MAX_CONNECTIONS  database connections the web process may open in all,
+                        default 30, leave room for the release and worker steps
+    GUNICORN_THREADS    threads per worker, default 4 bounded by the worker's
+                        connection pool
+    GUNICORN_TIMEOUT    seconds before a silent worker is restarted
+    PORT                port to listen on
+    PROMETHEUS_MULTIPROC_DIR
+                        where workers write the samples that /metrics adds up,
+                        emptied on every start
+"""
+import os
+import shutil
+import tempfile
+
+# The release step applies the migrations, workers must not race to create tables
+os.environ.setdefault("DB_AUTO_CREATE", "false")
+
+# Set before the app, and so prometheus_client, is loaded. Samples of the
+# workers of a previous run must not be added to this one.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "customers-metrics"))
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+# The CPU count is the host's inside a container, so the number of workers
+# follows from the connections the database allows instead
+pool_limit = int(os.getenv("DB_POOL_SIZE", "5")) + int(os.getenv("DB_MAX_OVERFLOW", "10"))
+max_connections = int(os.getenv("DB_MAX_CONNECTIONS", "30"))
+
+bind = "0.0.0.0:{}".format(os.getenv("PORT", "5000"))
+workers = int(os.getenv("WEB_CONCURRENCY", str(max(1, max_connections // pool_limit))))
+# More threads than pooled connections would only queue for a connection
+threads = int(os.getenv("GUNICORN_THREADS", str(max(1, min(4, pool_limit)))))
+worker_class = "gthread" if threads > 1 else "sync"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = 30
+keepalive = 5
+# Restart workers now and then so that slow leaks cannot accumulate
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = "-"
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    """ Makes sure a new worker opens its own database connections """
+    from service import app
+    from service.models import dispose_engines
+
+    dispose_engines(app)
+    server.log.info("Worker %s ready", worker.pid)
+
+
+def child_exit(server, worker):
+    """ Lets /metrics drop the live samples of a worker that is gone """
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:  # metrics are optional, see service/metrics.py
+        return
+    multiprocess.mark_process_dead(worker.pid)
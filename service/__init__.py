@@ -3,42 +3,63 @@ Package: service
 Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
+
+Importing the package has no side effects. create_app() builds an app, and
+service.app is the app built on first use, which is what gunicorn and the
+flask command load. No database connection is opened until the first
+request, so a worker starts even while the database is still coming up.
 """
-import os
-import sys
 import logging
 from flask import Flask
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object("config")
-
-# Import the routes After the Flask app is created
-from service import routes, models, error_handlers
-
-# Set up logging for production
-if __name__ != "__main__":
-    gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
-
-app.logger.info(70 * "*")
-app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    routes.init_db()  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service inititalized!")
+
+def create_app(config="config"):
+    """ Creates and configures a Flask app for the Customer service """
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    # Import the routes After the Flask app is created
+    from service import routes, models, error_handlers, commands, compression, assets, metrics
+
+    app.register_blueprint(routes.bp)
+    app.register_blueprint(error_handlers.bp)
+    # before compression, whose hook then runs first, so sizes are as sent
+    app.register_blueprint(metrics.bp)
+    app.register_blueprint(compression.bp)
+    app.register_blueprint(assets.bp)
+    app.cli.add_command(commands.db_upgrade)
+    app.cli.add_command(commands.db_recount)
+    app.cli.add_command(commands.webhooks_dispatch)
+    app.cli.add_command(commands.customers_import)
+    app.cli.add_command(commands.assets_compress)
+
+    # Set up logging for production
+    if __name__ != "__main__":
+        gunicorn_logger = logging.getLogger("gunicorn.error")
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+        app.logger.propagate = False
+        # Make all log formats consistent
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+        )
+        for handler in app.logger.handlers:
+            handler.setFormatter(formatter)
+        app.logger.info("Logging handler established")
+
+    app.logger.info(70 * "*")
+    app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    models.Customer.init_app(app)
+
+    app.logger.info("Service inititalized!")
+    return app
+
+
+def __getattr__(name):
+    """ Builds service.app the first time it is used """
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
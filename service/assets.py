@@ -0,0 +1,133 @@
+"""
+Module: assets
+
+Fingerprinted, precompressed static assets for the UI
+
+Every file under service/static is also served at /assets/ under a name
+that carries a hash of its content, e.g. css/site.3f2a9c1b.css, so it can
+be cached by browsers forever: a changed file gets a new URL. Templates link
+to them with asset_url().
+
+precompress() writes a .gz and, when brotli is installed, a .br copy next to
+each text asset once per build (bin/post_compile runs flask assets-compress),
+and the best copy the client accepts is sent. Without them the asset is sent
+as it is.
+"""
+import os
+import gzip
+import hashlib
+import mimetypes
+from flask import Blueprint, abort, current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Cache fingerprinted assets for a year, they never change under their URL
+MAX_AGE = 365 * 24 * 3600
+
+# Extensions of the assets that are worth compressing
+COMPRESSIBLE = (".css", ".js", ".html", ".svg", ".json", ".txt")
+
+# Suffixes of the precompressed copies, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+bp = Blueprint("assets", __name__)
+
+# Fingerprinted names of the assets of each static folder, computed once per worker
+_manifests = {}
+
+
+def fingerprint(path):
+    """ Returns a short hash of the content of a file """
+    digest = hashlib.md5()
+    with open(path, "rb") as asset:
+        for block in iter(lambda: asset.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def fingerprinted_name(filename, digest):
+    """ Inserts the digest before the extension: js/app.js becomes js/app.<digest>.js """
+    root, ext = os.path.splitext(filename)
+    return "{}.{}{}".format(root, digest, ext)
+
+
+def static_files(folder):
+    """ Yields the path of every asset in folder relative to it, without the precompressed copies """
+    for root, _, names in os.walk(folder):
+        for name in sorted(names):
+            if name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                continue
+            yield os.path.relpath(os.path.join(root, name), folder).replace(os.sep, "/")
+
+
+def manifest(folder):
+    """ Returns a dictionary from the file name of every asset in folder to its fingerprinted name """
+    if folder not in _manifests:
+        _manifests[folder] = {
+            filename: fingerprinted_name(filename, fingerprint(os.path.join(folder, filename)))
+            for filename in static_files(folder)
+        }
+    return _manifests[folder]
+
+
+def precompress(folder):
+    """Writes the .gz and .br copies of the text assets in folder that are missing or stale
+
+    Returns the paths written.
+    """
+    written = []
+    for filename in static_files(folder):
+        if not filename.endswith(COMPRESSIBLE):
+            continue
+        path = os.path.join(folder, filename)
+        with open(path, "rb") as asset:
+            data = None
+            for encoding, suffix in ENCODINGS:
+                target = path + suffix
+                if encoding == "br" and brotli is None:
+                    continue
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                data = data if data is not None else asset.read()
+                if encoding == "br":
+                    compressed = brotli.compress(data, quality=11)
+                else:
+                    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+                with open(target, "wb") as output:
+                    output.write(compressed)
+                written.append(target)
+    return written
+
+
+@bp.app_template_global()
+def asset_url(filename):
+    """ Returns the fingerprinted URL of a static asset """
+    return "/assets/" + manifest(current_app.static_folder)[filename]
+
+
+@bp.route("/assets/<path:name>")
+def send_asset(name):
+    """ Sends a fingerprinted asset, precompressed when the client accepts it """
+    folder = current_app.static_folder
+    # strip the fingerprint, and only answer for the current one
+    root, ext = os.path.splitext(name)
+    filename = os.path.splitext(root)[0] + ext
+    if manifest(folder).get(filename) != name:
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    sent, encoding = filename, None
+    for candidate, suffix in ENCODINGS:
+        if request.accept_encodings[candidate] and os.path.exists(os.path.join(folder, filename + suffix)):
+            sent, encoding = filename + suffix, candidate
+            break
+    response = send_from_directory(folder, sent, mimetype=mimetype, cache_timeout=MAX_AGE)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if filename.endswith(COMPRESSIBLE):
+        response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,111 @@
+"""
+Module: cache
+
+In process caches used for read-through lookups of single Customers
+
+Every cache has the same small interface (get, set, delete, clear and
+stats) so the Customer model can be given any of them. Each gunicorn worker
+holds its own cache, which is why entries also expire after a TTL: a write
+handled by one worker only invalidates that worker's copy.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class NullCache:
+    """ A cache that never stores anything, used to switch caching off """
+
+    def __init__(self):
+        self.misses = 0
+
+    def get(self, key):
+        """ Always misses """
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        """ Discards the value """
+
+    def delete(self, key):
+        """ Nothing to delete """
+
+    def clear(self):
+        """ Nothing to clear """
+
+    def stats(self):
+        """ Returns the cache counters """
+        return {"hits": 0, "misses": self.misses, "evictions": 0, "size": 0, "maxsize": 0, "ttl": 0}
+
+
+class LRUCache:
+    """
+    A thread safe least recently used cache whose entries expire
+
+    Args:
+        maxsize (int): the number of entries kept before the oldest is evicted
+        ttl (float): the number of seconds an entry stays valid
+        clock (callable): returns the current time in seconds
+    """
+
+    def __init__(self, maxsize=1024, ttl=5.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached value for key or None when missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """ Stores value under key, evicting the least recently used entry when full """
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """ Removes key from the cache if present """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the cache counters """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+
+
+def create_cache(maxsize, ttl):
+    """ Returns an LRUCache, or a NullCache when maxsize is 0 """
+    if maxsize <= 0:
+        return NullCache()
+    return LRUCache(maxsize=maxsize, ttl=ttl)
@@ -0,0 +1,152 @@
+"""
+Module: changes
+
+The Customer change positions behind GET /customers/changes
+
+Every write to a Customer stamps it with a position, and a delete leaves a
+tombstone in customer_tombstones stamped the same way. Triggers do the
+stamping, so the set based bulk statements are covered too. A consumer that
+remembers the highest position it has seen reads only the Customers and
+tombstones above it, through the position indexes, so syncing costs what
+changed rather than the size of the table.
+
+A position is a (change_txid, change_seq) pair. SQLite has one writer at a
+time, so a counter table in the writing transaction orders every change and
+change_txid stays 0. On Postgres writers run concurrently and no lock is
+taken: change_txid is the id of the writing transaction and change_seq comes
+from a SEQUENCE. A transaction may commit after others that got higher ids,
+so readers only take the changes of transactions below horizon(), which
+have all ended. Whatever commits later sorts above what was read. A long
+transaction delays the changes of those that started after it, it does not
+block them.
+"""
+from sqlalchemy import MetaData, Table, Column, Index, Integer, BigInteger, DateTime, and_, or_, select, text
+
+# The change tables live outside of the models metadata, they are created and
+# dropped along with the customer table they follow
+metadata = MetaData()
+
+customer_tombstones = Table(
+    "customer_tombstones",
+    metadata,
+    Column("customer_id", Integer, primary_key=True),
+    Column("change_txid", BigInteger, nullable=False, server_default="0"),
+    Column("change_seq", BigInteger, nullable=False),
+    Column("deleted_at", DateTime, nullable=False),
+    Index("ix_customer_tombstones_position", "change_txid", "change_seq"),
+)
+
+# SQLite only, Postgres uses the customer_change_seq SEQUENCE
+change_counter = Table(
+    "customer_change_counter",
+    metadata,
+    Column("value", BigInteger, nullable=False),
+)
+
+POSTGRES_DDL = (
+    "CREATE SEQUENCE IF NOT EXISTS customer_change_seq",
+    # never backwards, a value drawn by a write that rolled back may be above every stored one
+    "SELECT setval('customer_change_seq', GREATEST("
+    "(SELECT COALESCE(MAX(change_seq), 0) FROM customer), (SELECT COALESCE(MAX(customer_id), 0) FROM customer), "
+    "(SELECT COALESCE(MAX(change_seq), 0) FROM customer_tombstones), "
+    "(SELECT last_value FROM customer_change_seq), 1))",
+    "CREATE OR REPLACE FUNCTION customer_change_trigger() RETURNS trigger AS $$ BEGIN "
+    "IF TG_OP = 'DELETE' THEN "
+    "INSERT INTO customer_tombstones (customer_id, change_txid, change_seq, deleted_at) "
+    "VALUES (OLD.customer_id, txid_current(), nextval('customer_change_seq'), now()) "
+    "ON CONFLICT (customer_id) DO UPDATE SET change_txid = EXCLUDED.change_txid, "
+    "change_seq = EXCLUDED.change_seq, deleted_at = EXCLUDED.deleted_at; "
+    "RETURN OLD; END IF; "
+    # like on SQLite, an update that sets change_seq itself is the backfill of migration 7
+    "IF TG_OP = 'UPDATE' AND NEW.change_seq IS DISTINCT FROM OLD.change_seq THEN RETURN NEW; END IF; "
+    "NEW.change_txid := txid_current(); "
+    "NEW.change_seq := nextval('customer_change_seq'); "
+    "RETURN NEW; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS customer_change ON customer",
+    "CREATE TRIGGER customer_change BEFORE INSERT OR UPDATE OR DELETE ON customer "
+    "FOR EACH ROW EXECUTE PROCEDURE customer_change_trigger()",
+)
+
+SQLITE_DDL = (
+    "INSERT INTO customer_change_counter (value) SELECT MAX("
+    "(SELECT COALESCE(MAX(change_seq), 0) FROM customer), (SELECT COALESCE(MAX(customer_id), 0) FROM customer), "
+    "(SELECT COALESCE(MAX(change_seq), 0) FROM customer_tombstones)) "
+    "WHERE NOT EXISTS (SELECT 1 FROM customer_change_counter)",
+    "CREATE TRIGGER IF NOT EXISTS customer_change_insert AFTER INSERT ON customer BEGIN "
+    "UPDATE customer_change_counter SET value = value + 1; "
+    "UPDATE customer SET change_seq = (SELECT value FROM customer_change_counter) "
+    "WHERE customer_id = new.customer_id; END",
+    # stamping change_seq is itself an update, which the WHEN clause skips
+    "CREATE TRIGGER IF NOT EXISTS customer_change_update AFTER UPDATE ON customer "
+    "WHEN new.change_seq IS old.change_seq BEGIN "
+    "UPDATE customer_change_counter SET value = value + 1; "
+    "UPDATE customer SET change_seq = (SELECT value FROM customer_change_counter) "
+    "WHERE customer_id = new.customer_id; END",
+    "CREATE TRIGGER IF NOT EXISTS customer_change_delete AFTER DELETE ON customer BEGIN "
+    "UPDATE customer_change_counter SET value = value + 1; "
+    "INSERT OR REPLACE INTO customer_tombstones (customer_id, change_seq, deleted_at) "
+    "VALUES (old.customer_id, (SELECT value FROM customer_change_counter), CURRENT_TIMESTAMP); END",
+)
+
+
+def create_feed(connection):
+    """Creates the tombstone table, the sequence and the triggers that stamp changes
+
+    The sequence starts above every change_seq and customer_id already
+    stored, so rows stamped later always sort after existing ones. Returns
+    False when the database has no triggers this module knows.
+    """
+    if connection.dialect.name == "postgresql":
+        customer_tombstones.create(connection, checkfirst=True)
+        statements = POSTGRES_DDL
+    elif connection.dialect.name == "sqlite":
+        metadata.create_all(connection)
+        statements = SQLITE_DDL
+    else:
+        return False
+    for statement in statements:
+        connection.execute(text(statement))
+    return True
+
+
+def drop_feed(connection):
+    """ Drops the change tables, the triggers go with the customer table """
+    metadata.drop_all(connection, checkfirst=True)
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("DROP SEQUENCE IF EXISTS customer_change_seq"))
+
+
+def horizon(connection):
+    """Returns the transaction id below which every writing transaction has ended
+
+    Changes stamped below it are final, those at or above it are left for a
+    later read. Returns None where writes are serialized and every change
+    can be read as soon as it is visible.
+    """
+    if connection.dialect.name != "postgresql":
+        return None
+    return connection.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+
+
+def after(txid, seq, position):
+    """ Returns the condition that the position in the txid and seq columns comes after position """
+    return or_(txid > position[0], and_(txid == position[0], seq > position[1]))
+
+
+def tombstones(session, since, limit, horizon=None):
+    """Returns up to limit (customer_id, change_txid, change_seq) rows of the Customers deleted after since
+
+    Args:
+        since (tuple): the position to read after
+        limit (int): the maximum number of rows to return
+        horizon (int): only read the tombstones of transactions below it
+    """
+    table = customer_tombstones
+    query = select([table.c.customer_id, table.c.change_txid, table.c.change_seq]).where(
+        after(table.c.change_txid, table.c.change_seq, since)
+    )
+    if horizon is not None:
+        query = query.where(table.c.change_txid < horizon)
+    return session.execute(
+        query.order_by(table.c.change_txid, table.c.change_seq).limit(limit)
+    ).fetchall()
@@ -0,0 +1,103 @@
+"""
+Module: commands
+
+Flask CLI commands used to operate the service
+"""
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+
+@click.command("db-upgrade")
+@with_appcontext
+def db_upgrade():
+    """Applies any pending database migrations"""
+    from service import migrations
+
+    versions = migrations.upgrade()
+    if versions:
+        click.echo("Applied migrations: {}".format(", ".join(str(x) for x in versions)))
+    else:
+        click.echo("Database is up to date")
+
+
+@click.command("db-recount")
+@with_appcontext
+def db_recount():
+    """Recounts the Customers into the counter table"""
+    from service import counts
+    from service.models import db
+
+    with db.engine.begin() as connection:
+        counts.refresh(connection)
+    click.echo("Recounted the Customers")
+
+
+@click.command("webhooks-dispatch")
+@click.option("--once", is_flag=True, help="Deliver what is pending once and exit")
+@with_appcontext
+def webhooks_dispatch(once):
+    """Delivers the Customer events to the WEBHOOK_URLS until stopped"""
+    import signal
+    import threading
+    from service.models import db
+    from service.outbox import Dispatcher
+
+    dispatcher = Dispatcher.from_config(current_app.config, db.engine)
+    if once:
+        dispatcher.sync_subscribers()
+        click.echo("Delivered {} events".format(dispatcher.run_once()))
+        return
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    click.echo("Delivering Customer events to {}".format(", ".join(dispatcher.urls) or "nobody"))
+    dispatcher.run(stop, current_app.config.get("WEBHOOK_POLL_INTERVAL", 1))
+
+
+@click.command("customers-import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+              help="Format of the file, by default taken from its extension")
+@click.option("--rejects", type=click.Path(dir_okay=False),
+              help="Where to write the rows that are not valid, by default next to the file")
+@click.option("--chunk-size", type=int, help="Rows loaded per transaction, IMPORT_CHUNK_SIZE by default")
+@with_appcontext
+def customers_import(path, file_format, rejects, chunk_size):
+    """Imports the Customers of a CSV or NDJSON file"""
+    import os
+    from service import importer
+    from service.models import db
+
+    root, ext = os.path.splitext(path)
+    file_format = file_format or ("ndjson" if ext.lower() in (".ndjson", ".jsonl") else "csv")
+    rejects = rejects or "{}.rejects.{}".format(root, file_format)
+
+    def progress(counts):
+        click.echo("Read {read}, imported {imported}, rejected {rejected}".format(**counts), err=True)
+
+    with open(path, encoding="utf-8-sig", newline="") as lines, \
+            open(rejects, "w", encoding="utf-8", newline="") as reject_file:
+        counts = importer.import_customers(
+            db.engine,
+            lines,
+            file_format,
+            chunk_size=chunk_size or current_app.config.get("IMPORT_CHUNK_SIZE", 5000),
+            reject=importer.RejectWriter(reject_file, file_format),
+            progress=progress,
+        )
+    if not counts["rejected"]:
+        os.remove(rejects)
+    click.echo("Imported {imported} of {read} Customers".format(**counts))
+    if counts["rejected"]:
+        click.echo("Rejected {} rows, see {}".format(counts["rejected"], rejects))
+
+
+@click.command("assets-compress")
+@with_appcontext
+def assets_compress():
+    """Writes the precompressed copies of the static assets"""
+    from service import assets
+
+    written = assets.precompress(current_app.static_folder)
+    click.echo("Compressed {} static assets".format(len(written)))
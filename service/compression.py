@@ -0,0 +1,103 @@
+"""
+Module: compression
+
+Negotiated gzip / brotli compression of API responses
+
+Responses are compressed when the client accepts it, the body is text and
+at least COMPRESS_MIN_SIZE bytes. Streamed responses, such as exports, are
+compressed chunk by chunk as they are sent so they are never held in
+memory. Brotli is preferred when installed and accepted, gzip otherwise.
+
+A strong ETag promises identical bytes, so a compressed response gets the
+encoding appended to it ("7-gzip"). identity_etag() maps such a tag back
+for the conditional requests that compare it with the row version.
+"""
+import zlib
+from flask import Blueprint, current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Media types worth compressing
+COMPRESSIBLE = {
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "image/svg+xml",
+}
+
+bp = Blueprint("compression", __name__)
+
+
+def negotiate():
+    """ Returns the best encoding the client accepts, or None """
+    if brotli is not None and request.accept_encodings["br"]:
+        return "br"
+    if request.accept_encodings["gzip"]:
+        return "gzip"
+    return None
+
+
+def identity_etag(etag):
+    """ Returns the ETag of the uncompressed response an encoding specific ETag stands for """
+    for encoding in ("br", "gzip"):
+        if etag.endswith("-" + encoding):
+            return etag[: -len(encoding) - 1]
+    return etag
+
+
+def compressor(encoding):
+    """ Returns functions that compress a chunk, flush what was compressed so far and finish the stream """
+    if encoding == "br":
+        stream = brotli.Compressor(quality=current_app.config.get("BROTLI_QUALITY", 4))
+        return stream.process, stream.flush, stream.finish
+    # wbits 31 writes a gzip header and trailer around the deflate stream
+    stream = zlib.compressobj(current_app.config.get("GZIP_LEVEL", 6), zlib.DEFLATED, 31)
+    return stream.compress, lambda: stream.flush(zlib.Z_SYNC_FLUSH), stream.flush
+
+
+def compress_chunks(chunks, process, flush, finish):
+    """ Yields the compressed chunks of a streamed body
+
+    Every chunk is flushed, so the client can decompress what was sent so
+    far instead of waiting for the compressor to fill its window.
+    """
+    for chunk in chunks:
+        data = process(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+@bp.after_app_request
+def compress_response(response):
+    """ Compresses the response body when the client accepts it """
+    if (
+        response.mimetype not in COMPRESSIBLE and not (response.mimetype or "").startswith("text/")
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    if not response.is_streamed and response.calculate_content_length() < current_app.config.get(
+        "COMPRESS_MIN_SIZE", 1024
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    process, flush, finish = compressor(encoding)
+    if response.is_streamed:
+        response.response = compress_chunks(response.iter_encoded(), process, flush, finish)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(process(response.get_data()) + finish())
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag("{}-{}".format(etag, encoding))
+    return response
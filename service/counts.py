@@ -0,0 +1,147 @@
+"""
+Module: counts
+
+Customer totals kept up to date by the database
+
+The customer_counts table holds the number of Customers with each value of
+active, split over shard rows that are summed on read. Triggers on the
+customer table adjust one shard on every insert, delete and change of
+active, including the set based bulk statements, so the totals are read
+from a handful of rows instead of counting the whole table. The triggers
+run in the writing transaction, so the totals are exact and roll back with
+it.
+
+On Postgres a write adjusts the shard of its transaction id, so concurrent
+writers mostly lock different rows instead of queueing on one. SQLite has
+one writer at a time and a single shard.
+"""
+from contextlib import contextmanager
+from sqlalchemy import MetaData, Table, Column, Boolean, BigInteger, Integer, func, select, text
+
+# The counter table lives outside of the models metadata, it is created and
+# dropped along with the customer table it counts
+metadata = MetaData()
+
+customer_counts = Table(
+    "customer_counts",
+    metadata,
+    Column("active", Boolean, primary_key=True),
+    Column("shard", Integer, primary_key=True),
+    Column("total", BigInteger, nullable=False),
+)
+
+# Rows per value of active on Postgres
+SHARDS = 16
+
+POSTGRES_DDL = (
+    "CREATE OR REPLACE FUNCTION customer_counts_trigger() RETURNS trigger AS $$ "
+    "DECLARE target int := txid_current() % {shards}; BEGIN "
+    "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+    "UPDATE customer_counts SET total = total + 1 WHERE active = NEW.active AND shard = target; END IF; "
+    "IF TG_OP IN ('DELETE', 'UPDATE') THEN "
+    "UPDATE customer_counts SET total = total - 1 WHERE active = OLD.active AND shard = target; END IF; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS customer_counts_insert_delete ON customer",
+    "CREATE TRIGGER customer_counts_insert_delete AFTER INSERT OR DELETE ON customer "
+    "FOR EACH ROW EXECUTE PROCEDURE customer_counts_trigger()",
+    "DROP TRIGGER IF EXISTS customer_counts_update ON customer",
+    "CREATE TRIGGER customer_counts_update AFTER UPDATE OF active ON customer "
+    "FOR EACH ROW WHEN (OLD.active IS DISTINCT FROM NEW.active) EXECUTE PROCEDURE customer_counts_trigger()",
+)
+
+SQLITE_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS customer_counts_insert AFTER INSERT ON customer BEGIN "
+    "UPDATE customer_counts SET total = total + 1 WHERE active = new.active AND shard = 0; END",
+    "CREATE TRIGGER IF NOT EXISTS customer_counts_delete AFTER DELETE ON customer BEGIN "
+    "UPDATE customer_counts SET total = total - 1 WHERE active = old.active AND shard = 0; END",
+    "CREATE TRIGGER IF NOT EXISTS customer_counts_update AFTER UPDATE OF active ON customer "
+    "WHEN old.active <> new.active BEGIN "
+    "UPDATE customer_counts SET total = total - 1 WHERE active = old.active AND shard = 0; "
+    "UPDATE customer_counts SET total = total + 1 WHERE active = new.active AND shard = 0; END",
+)
+
+
+@contextmanager
+def transaction(connection):
+    """Yields a connection in a transaction
+
+    That is connection itself when it is in one or can begin one, or a new
+    connection of the same engine when connection autocommits, as the
+    migrations do on Postgres.
+    """
+    if connection.get_execution_options().get("isolation_level") == "AUTOCOMMIT":
+        with connection.engine.begin() as other:
+            yield other
+    elif connection.in_transaction():
+        yield connection
+    else:
+        with connection.begin():
+            yield connection
+
+
+def create_counts(connection):
+    """Creates the counter table and its triggers, and counts the existing Customers
+
+    Everything happens in one transaction, which on Postgres holds back
+    writes to the customer table until the counts are in. Returns False
+    when the database has no triggers this module knows, the totals are
+    then counted on every read.
+    """
+    if connection.dialect.name == "postgresql":
+        statements = [ddl.format(shards=SHARDS) for ddl in POSTGRES_DDL]
+    elif connection.dialect.name == "sqlite":
+        statements = SQLITE_DDL
+    else:
+        return False
+    with transaction(connection) as connection:
+        customer_counts.create(connection, checkfirst=True)
+        for statement in statements:
+            connection.execute(text(statement))
+        refresh(connection)
+    return True
+
+
+def refresh(connection):
+    """Recounts the Customers into the counter table
+
+    The customer table is locked against writes until the new totals
+    commit, so no write is counted twice or missed, and no other refresh
+    runs at the same time.
+    """
+    shards = SHARDS if connection.dialect.name == "postgresql" else 1
+    with transaction(connection) as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("LOCK TABLE customer IN SHARE ROW EXCLUSIVE MODE"))
+        connection.execute(customer_counts.delete())
+        for active in (True, False):
+            connection.execute(
+                text(
+                    "INSERT INTO customer_counts (active, shard, total) "
+                    "SELECT :active, 0, COUNT(*) FROM customer WHERE active = :active"
+                ),
+                {"active": active},
+            )
+            if shards > 1:
+                connection.execute(
+                    customer_counts.insert(),
+                    [{"active": active, "shard": shard, "total": 0} for shard in range(1, shards)],
+                )
+
+
+def drop_counts(connection):
+    """ Drops the counter table, the triggers go with the customer table """
+    customer_counts.drop(connection, checkfirst=True)
+
+
+def totals(session):
+    """Returns the number of active and inactive Customers as a dictionary
+
+    Returns None when the counter table was never filled.
+    """
+    table = customer_counts
+    rows = session.execute(
+        select([table.c.active, func.sum(table.c.total)]).group_by(table.c.active)
+    ).fetchall()
+    if len(rows) != 2:
+        return None
+    return {bool(active): int(total) for active, total in rows}
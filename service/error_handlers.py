@@ -14,24 +14,27 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
+from flask import Blueprint, current_app, jsonify
 from service.models import DataValidationError
-from . import app, status
+from . import status
+
+# The handlers apply to the whole app once service.create_app() registers this
+bp = Blueprint("errors", __name__)
 
 #####################################################################
 #Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
+@bp.app_errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+@bp.app_errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad reuests with 400_BAD_REQUEST"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message
@@ -0,0 +1,30 @@
+"""
+Module: green
+
+Cooperative (gevent) serving mode for the Customer service
+
+The default gunicorn worker handles one request at a time, so one slow
+query blocks the worker. Under the gevent worker every request runs in a
+greenlet and yields to the others while it waits on the network or the
+database, so a few processes hold thousands of concurrent clients without a
+thread per request. The /customers API and the Customer model are the same
+objects as in the default mode; only the I/O underneath becomes cooperative:
+
+    gunicorn --worker-class=gevent --worker-connections=1000 service.green:app
+
+psycopg2 is a C extension that gevent cannot patch on its own, so it is
+switched to its asynchronous interface here before the first connection.
+Size DB_POOL_SIZE and DB_MAX_OVERFLOW for the queries you want in flight,
+the other greenlets wait for a pooled connection without blocking the worker.
+"""
+from gevent import monkey
+
+# gunicorn's gevent worker has already patched the standard library, this
+# covers running the module under any other gevent server
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+
+patch_psycopg()
+
+from service import app  # noqa: E402,F401
@@ -0,0 +1,175 @@
+"""
+Module: importer
+
+Streaming bulk import of Customers from CSV or NDJSON
+
+Rows are read one at a time, validated with Customer.deserialize() and the
+column limits of the customer table, and loaded in chunks of chunk_size
+rows, one transaction per chunk, so memory stays flat however large the
+file is. Postgres loads each chunk with COPY, other databases with one
+executemany INSERT. Rows that are not valid never reach the database, they
+are handed to a reject callback with their line number and the reason.
+
+CSV files have a header line with the Customer fields, as written by
+GET /customers/export?format=csv. NDJSON files have one Customer object
+per line.
+"""
+import io
+import csv
+import json
+import logging
+from service.models import Customer, DataValidationError
+
+logger = logging.getLogger("flask.app")
+
+FORMATS = ("csv", "ndjson")
+
+# Spellings of active accepted in CSV files
+BOOLEANS = {"true": True, "t": True, "1": True, "yes": True, "false": False, "f": False, "0": False, "no": False}
+
+
+def read_csv(lines):
+    """Yields (line number, raw row, data) for every row of a CSV file
+
+    data is the Customer dictionary, or a DataValidationError when the row
+    cannot be one. Empty values are read as null.
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        if None in row:
+            yield reader.line_num, row, DataValidationError("Invalid row: more values than columns")
+            continue
+        data = {name: (value if value != "" else None) for name, value in row.items()}
+        if isinstance(data.get("active"), str):
+            if data["active"].lower() not in BOOLEANS:
+                yield reader.line_num, row, DataValidationError("Invalid active: " + data["active"])
+                continue
+            data["active"] = BOOLEANS[data["active"].lower()]
+        yield reader.line_num, row, data
+
+
+def read_ndjson(lines):
+    """ Yields (line number, raw line, data) for every non blank line of an NDJSON file """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as error:
+            data = DataValidationError("Invalid JSON: {}".format(error))
+        yield number, line.rstrip("\n"), data
+
+
+def validate(data):
+    """Returns the column values of a Customer dictionary
+
+    Raises a DataValidationError for anything deserialize() rejects or the
+    customer table could not store, so that no row can fail a whole chunk.
+    """
+    values = Customer().deserialize(data).column_values()
+    Customer.check_columns(values)
+    return values
+
+
+# Characters that the text format of COPY needs escaped
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_value(value):
+    """ Writes a value in the text format of COPY, where \\N is null """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_rows(connection, rows):
+    """ Loads rows into the customer table with a Postgres COPY """
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(row[name]) for name in columns) + "\n")
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert("COPY {} ({}) FROM STDIN".format(Customer.__table__.name, ", ".join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+def insert_rows(connection, rows):
+    """ Loads rows into the customer table with one executemany INSERT """
+    connection.execute(Customer.__table__.insert(), rows)
+
+
+def import_customers(engine, lines, format="csv", chunk_size=5000, reject=None, progress=None):
+    """Imports the Customers of a CSV or NDJSON file and returns the counts
+
+    Args:
+        engine: the engine of the database to load
+        lines: an iterable of the text lines of the file
+        format (str): csv or ndjson
+        chunk_size (int): the number of rows loaded per transaction
+        reject (callable): called with the line number, raw row and reason of every invalid row
+        progress (callable): called with the counts after every chunk
+
+    Returns a dictionary of the rows read, imported and rejected.
+    """
+    if format not in FORMATS:
+        raise DataValidationError("Invalid format: {}".format(format))
+    load = copy_rows if engine.dialect.name == "postgresql" else insert_rows
+    counts = {"read": 0, "imported": 0, "rejected": 0}
+    chunk = []
+
+    def flush():
+        with engine.begin() as connection:
+            load(connection, chunk)
+        counts["imported"] += len(chunk)
+        chunk.clear()
+        logger.info("Imported %(imported)s Customers, rejected %(rejected)s", counts)
+        if progress:
+            progress(dict(counts))
+
+    rows = read_csv(lines) if format == "csv" else read_ndjson(lines)
+    for number, raw, data in rows:
+        counts["read"] += 1
+        try:
+            if isinstance(data, DataValidationError):
+                raise data
+            chunk.append(validate(data))
+        except DataValidationError as error:
+            counts["rejected"] += 1
+            if reject:
+                reject(number, raw, str(error))
+            continue
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return counts
+
+
+class RejectWriter:
+    """
+    Writes rejected rows to a file in the format they were read in
+
+    CSV rejects keep their values under the header of the file, followed by
+    the line number and the reason. NDJSON rejects are objects with the line
+    number, the reason and the original line.
+    """
+
+    def __init__(self, file, format):
+        self.file = file
+        self.format = format
+        self.writer = None
+
+    def __call__(self, number, raw, error):
+        if self.format == "ndjson":
+            self.file.write(json.dumps({"line": number, "error": error, "row": raw}) + "\n")
+            return
+        row = {name: value for name, value in raw.items() if name is not None}
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(row) + ["line", "error"], extrasaction="ignore")
+            self.writer.writeheader()
+        self.writer.writerow(dict(row, line=number, error=error))
@@ -0,0 +1,138 @@
+"""
+Module: metrics
+
+Prometheus metrics of the requests served, at /metrics
+
+Every request is counted by endpoint and status, and its latency, response
+size and time spent in the database are observed in histograms by
+endpoint. Endpoints are named after the flask-restx resource method that
+served them, such as CustomerCollection.get, or after the Flask endpoint
+for other views, which keeps the number of series bounded.
+
+Under gunicorn every worker writes its samples to memory mapped files in
+PROMETHEUS_MULTIPROC_DIR, which gunicorn.conf.py sets up, and /metrics adds
+up the files of all workers, so any worker answers a scrape with the totals.
+Observing a sample only updates those files, there is no locking across
+processes on the request path.
+
+The latency of a streamed response, such as an export, stops when its first
+byte is ready. prometheus_client is optional: without it nothing is measured
+and /metrics is not found.
+"""
+import os
+from time import perf_counter
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+bp = Blueprint("metrics", __name__)
+
+# Seconds, from a cache hit to a large export
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Bytes, from an empty body to a large page
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+if prometheus_client is not None:
+    REQUESTS = prometheus_client.Counter(
+        "http_requests", "Requests served", ["endpoint", "status"]
+    )
+    LATENCY = prometheus_client.Histogram(
+        "http_request_duration_seconds", "Time to handle a request", ["endpoint"], buckets=LATENCY_BUCKETS
+    )
+    SIZE = prometheus_client.Histogram(
+        "http_response_size_bytes", "Size of the response body", ["endpoint"], buckets=SIZE_BUCKETS
+    )
+    DB_TIME = prometheus_client.Histogram(
+        "http_request_db_seconds", "Time a request spent in database queries", ["endpoint"], buckets=LATENCY_BUCKETS
+    )
+
+# (endpoint, status) -> labelled metrics, resolved once per process
+_series = {}
+
+
+def endpoint_name():
+    """ Returns the name of the resource method, or Flask endpoint, that serves the request """
+    if request.url_rule is None:
+        return "none"
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, "view_class", None)
+    if view_class is None:
+        return request.endpoint
+    method = request.method.lower()
+    if method == "head" and not hasattr(view_class, "head"):
+        method = "get"
+    return "{}.{}".format(view_class.__name__, method)
+
+
+def series(endpoint, code):
+    """ Returns the labelled metrics of an endpoint and status """
+    key = (endpoint, code)
+    if key not in _series:
+        _series[key] = (
+            REQUESTS.labels(endpoint, str(code)),
+            LATENCY.labels(endpoint),
+            SIZE.labels(endpoint),
+            DB_TIME.labels(endpoint),
+        )
+    return _series[key]
+
+
+@bp.before_app_request
+def start_timer():
+    """ Notes when the request started """
+    g.metrics_start = perf_counter()
+    g.db_seconds = 0.0
+
+
+@bp.after_app_request
+def observe_request(response):
+    """ Records the metrics of a request as its response leaves """
+    if prometheus_client is None or "metrics_start" not in g:
+        return response
+    requests, latency, size, db_time = series(endpoint_name(), response.status_code)
+    requests.inc()
+    latency.observe(perf_counter() - g.metrics_start)
+    db_time.observe(g.db_seconds)
+    if response.content_length is not None:
+        size.observe(response.content_length)
+    return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a query started """
+    if context is not None:
+        context.metrics_start = perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    """ Adds the time of a query to the database time of the request that made it """
+    if context is not None and has_request_context() and "db_seconds" in g:
+        g.db_seconds += perf_counter() - context.metrics_start
+
+
+def registry():
+    """ Returns the registry to export, all workers combined in multiprocess mode """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return prometheus_client.REGISTRY
+    combined = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(combined)
+    return combined
+
+
+@bp.route("/metrics")
+def metrics():
+    """ Exports the metrics in the Prometheus text format """
+    if prometheus_client is None:
+        abort(404)
+    return Response(
+        prometheus_client.generate_latest(registry()),
+        headers={"Content-Type": prometheus_client.CONTENT_TYPE_LATEST},
+    )
@@ -0,0 +1,253 @@
+"""
+Module: migrations
+
+Versioned schema migrations for the Customer service
+
+db.create_all() only creates tables that are missing, so changes to tables
+that already hold data (new indexes, new columns) are made here instead.
+Each migration runs once, in order, and is recorded in the schema_migrations
+table. Apply them with:
+
+    flask db-upgrade
+
+which the Procfile runs as the release step of every deploy.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, inspect, select, text
+from sqlalchemy import bindparam
+from sqlalchemy.schema import CreateColumn
+from service import changes, counts, outbox, search
+from service.models import db, Customer, phone_country_code
+
+logger = logging.getLogger("flask.app")
+
+# The Customer columns that the derived columns are computed from
+SOURCE_COLUMNS = ("firstname", "lastname", "email_id", "phone_number")
+
+# Any fixed key works, it only has to be the same for every instance
+MIGRATION_LOCK_KEY = 7352002
+
+# The bookkeeping table lives outside of the models metadata so that
+# db.create_all() and db.drop_all() never touch it
+metadata = MetaData()
+
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(255)),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+######################################################################
+#  M I G R A T I O N   H E L P E R S
+######################################################################
+def create_index(connection, index):
+    """Builds an index, without blocking writes on Postgres
+
+    CREATE INDEX CONCURRENTLY cannot run inside a transaction, which is
+    why upgrade() runs every migration in autocommit mode on Postgres.
+    """
+    columns = ", ".join(column.name for column in index.columns)
+    concurrently, using = "", ""
+    if connection.dialect.name == "postgresql":
+        concurrently = "CONCURRENTLY "
+        if index.dialect_options["postgresql"]["using"]:
+            using = "USING {} ".format(index.dialect_options["postgresql"]["using"])
+    logger.info("Creating index %s on %s (%s)", index.name, index.table.name, columns)
+    connection.execute(
+        text(
+            "CREATE INDEX {}IF NOT EXISTS {} ON {} {}({})".format(
+                concurrently, index.name, index.table.name, using, columns
+            )
+        )
+    )
+
+
+def add_column(connection, column):
+    """Adds a model column to its existing table unless it is already there"""
+    table = column.table.name
+    if column.name in {x["name"] for x in inspect(connection).get_columns(table)}:
+        return
+    logger.info("Adding column %s to %s", column.name, table)
+    ddl = CreateColumn(column).compile(dialect=connection.dialect)
+    connection.execute(text("ALTER TABLE {} ADD COLUMN {}".format(table, ddl)))
+
+
+def customer_columns(*names):
+    """Returns a migration that adds the named columns to the Customer table"""
+
+    def migrate(connection):
+        for name in names:
+            add_column(connection, Customer.__table__.c[name])
+
+    return migrate
+
+
+def customer_indexes(*names):
+    """Returns a migration that creates the named indexes of the Customer table"""
+
+    def migrate(connection):
+        indexes = {index.name: index for index in Customer.__table__.indexes}
+        for name in names:
+            create_index(connection, indexes[name])
+
+    return migrate
+
+
+def backfill(connection, compute, sources=SOURCE_COLUMNS, where=None, batch_size=1000):
+    """Fills derived Customer columns for every existing row, one keyset batch at a time
+
+    Only the source columns are read, so a migration keeps working once later
+    migrations have added columns to the model.
+
+    Args:
+        compute (callable): returns the column values of a Customer row
+        sources (tuple): the names of the columns compute reads
+        where: an optional condition that the rows to fill must match
+        batch_size (int): the number of rows read and written per round trip
+    """
+    table = Customer.__table__
+    columns = [table.c.customer_id] + [table.c[name] for name in sources]
+    after, total = 0, 0
+    while True:
+        query = select(columns).where(table.c.customer_id > after)
+        if where is not None:
+            query = query.where(where)
+        rows = connection.execute(
+            query
+            .order_by(table.c.customer_id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        updates = [dict(compute(row), _customer_id=row["customer_id"]) for row in rows]
+        values = {name: bindparam(name) for name in updates[0] if name != "_customer_id"}
+        connection.execute(
+            table.update().where(table.c.customer_id == bindparam("_customer_id")).values(values), updates
+        )
+        after = rows[-1]["customer_id"]
+        total += len(rows)
+    logger.info("Backfilled %s Customers", total)
+
+
+def add_search(connection):
+    """Adds and fills search_text, then builds the search index over it"""
+    add_column(connection, Customer.__table__.c.search_text)
+    backfill(
+        connection,
+        lambda row: {
+            "search_text": search.search_text(
+                row["firstname"], row["lastname"], row["email_id"], row["phone_number"]
+            )
+        },
+    )
+    search.create_index(connection, concurrently=connection.dialect.name == "postgresql")
+
+
+def add_lookup_keys(connection):
+    """Adds and fills the email and phone lookup keys, then indexes them"""
+    for name in ("email_key", "phone_key"):
+        add_column(connection, Customer.__table__.c[name])
+    backfill(
+        connection,
+        lambda row: {
+            "email_key": search.email_key(row["email_id"]),
+            "phone_key": search.phone_key(row["phone_number"], phone_country_code()),
+        },
+        sources=("email_id", "phone_number"),
+    )
+    customer_indexes("ix_customer_email_key", "ix_customer_phone_key")(connection)
+
+
+def add_change_feed(connection):
+    """Adds the change position and starts stamping writes, then stamps the existing rows
+
+    The triggers go in first, so no write is missed while older rows are
+    stamped with their customer_id, which the sequence starts above.
+    """
+    table = Customer.__table__
+    add_column(connection, table.c.change_txid)
+    add_column(connection, table.c.change_seq)
+    changes.create_feed(connection)
+    backfill(
+        connection,
+        lambda row: {"change_seq": row["customer_id"]},
+        sources=(),
+        where=table.c.change_seq.is_(None),
+    )
+    customer_indexes("ix_customer_change_position")(connection)
+
+
+def create_tables(connection):
+    """Creates any table from the models that does not exist yet"""
+    db.Model.metadata.create_all(connection)
+
+
+######################################################################
+#  M I G R A T I O N S   (append only, never renumber)
+######################################################################
+MIGRATIONS = [
+    (1, "Create the initial tables", create_tables),
+    (
+        2,
+        "Index the Customer lookup columns",
+        customer_indexes(
+            "ix_customer_firstname",
+            "ix_customer_lastname",
+            "ix_customer_email_id",
+            "ix_customer_phone_number",
+            "ix_customer_active_customer_id",
+        ),
+    ),
+    (3, "Add the Customer row version", customer_columns("version")),
+    (4, "Add the indexed Customer search text", add_search),
+    (5, "Add the indexed Customer email and phone lookup keys", add_lookup_keys),
+    (6, "Count Customers in a table kept by triggers", counts.create_counts),
+    (7, "Add the Customer change feed", add_change_feed),
+    (8, "Add the Customer event outbox", lambda connection: outbox.create_outbox(connection, Customer.FIELDS)),
+]
+
+
+def applied_versions(engine):
+    """Returns the set of migration versions already applied"""
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        return {row[0] for row in connection.execute(select([schema_migrations.c.version]))}
+
+
+def upgrade(engine=None):
+    """Applies every pending migration in order and returns their versions
+
+    On Postgres the upgrade holds an advisory lock, so when several
+    instances are released at once one applies the migrations while the
+    others wait and then find nothing left to do.
+    """
+    engine = engine or db.engine
+    with engine.connect() as lock:
+        postgres = lock.dialect.name == "postgresql"
+        if postgres:
+            # a session lock taken in autocommit holds no snapshot, which
+            # CREATE INDEX CONCURRENTLY would otherwise wait on forever
+            lock = lock.execution_options(isolation_level="AUTOCOMMIT")
+            lock.execute(text("SELECT pg_advisory_lock(:key)"), key=MIGRATION_LOCK_KEY)
+        try:
+            applied = applied_versions(engine)
+            pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+            for version, description, migrate in pending:
+                logger.info("Applying migration %s: %s", version, description)
+                with engine.connect() as connection:
+                    if postgres:
+                        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+                    migrate(connection)
+                    connection.execute(
+                        schema_migrations.insert().values(
+                            version=version, description=description, applied_at=datetime.utcnow()
+                        )
+                    )
+        finally:
+            if postgres:
+                lock.execute(text("SELECT pg_advisory_unlock(:key)"), key=MIGRATION_LOCK_KEY)
+    return [version for version, _, _ in pending]
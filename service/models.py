@@ -4,12 +4,69 @@ Models for Customer
 All of the models are stored in this module
 """
 import logging
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import case, event, func, or_, orm, text
+from sqlalchemy.sql.expression import Select
+from service import changes, counts, search
+from service.cache import NullCache, create_cache
 
 logger = logging.getLogger("flask.app")
 
+# Name of the SQLALCHEMY_BINDS entry that points at a read replica
+REPLICA_BIND = "replica"
+
+# Name of the app.extensions entry that holds the app's Customer cache
+CACHE_EXTENSION = "customer_cache"
+
+
+def customer_cache():
+    """ Returns the read-through cache of serialized Customers of the current app
+
+    Outside of an app, or before init_app(), nothing is cached.
+    """
+    if has_app_context():
+        return current_app.extensions.get(CACHE_EXTENSION) or NullCache()
+    return NullCache()
+
+
+def phone_country_code():
+    """ Returns the country of the phone numbers written without an international prefix """
+    if has_app_context():
+        return current_app.config.get("PHONE_COUNTRY_CODE", "1")
+    return "1"
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends reads to the read replica, when one is configured
+
+    Writes always go to the primary. Once a session has written, or when
+    it is told to with info["primary"], it reads from the primary as well
+    so that it sees its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        binds = self.app.config.get("SQLALCHEMY_BINDS") or {}
+        if REPLICA_BIND not in binds:
+            return super().get_bind(mapper, clause)
+        reading = isinstance(clause, Select) or (clause is None and mapper is not None)
+        if self._flushing or not reading:
+            self.info["wrote"] = True
+        elif not (self.info.get("wrote") or self.info.get("primary")):
+            return db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy whose sessions route reads to a replica """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
@@ -27,17 +84,48 @@ class Customer(db.Model):
     Class that represents a <your resource model name>
     """
 
-    app = None
+    # Fields of the serialized representation, in order
+    FIELDS = ("customer_id", "firstname", "lastname", "email_id", "address", "phone_number", "card_number", "active")
+    # Columns that queries and bulk operations may select Customers by
+    FILTER_COLUMNS = ("firstname", "lastname", "email_id", "phone_number", "active")
+    # Filter columns that also accept prefix matches such as "Jo*"
+    TEXT_COLUMNS = ("firstname", "lastname", "email_id", "phone_number")
 
     # Table Schema
     customer_id = db.Column(db.Integer, primary_key=True)
-    firstname = db.Column(db.String(63))
-    lastname = db.Column(db.String(63))
-    email_id = db.Column(db.String(63))
+    firstname = db.Column(db.String(63), index=True)
+    lastname = db.Column(db.String(63), index=True)
+    email_id = db.Column(db.String(63), index=True)
     address = db.Column(db.String(63))
-    phone_number = db.Column(db.String(32))
+    phone_number = db.Column(db.String(32), index=True)
     card_number = db.Column(db.String(32), nullable=True)
     active = db.Column(db.Boolean, nullable=False)
+    # Row version, incremented by every write and published as the ETag
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # Lowercase names, email and phone digits that searches match against
+    search_text = db.Column(db.String(255))
+    # Canonical email and E.164 phone number that lookups match exactly
+    email_key = db.Column(db.String(63))
+    phone_key = db.Column(db.String(20))
+    # Position of the latest write in the change feed, stamped by the database
+    change_txid = db.Column(db.BigInteger, nullable=False, server_default="0")
+    change_seq = db.Column(db.BigInteger)
+
+    # Serves active filters and keyset pagination within them. AUTOINCREMENT
+    # stops SQLite from reusing the id of a deleted row, so an id and version
+    # pair never describes two different rows.
+    #
+    # The lookup keys only ever see equality, which Postgres hash indexes
+    # serve in a single probe. They are not unique because Customers that
+    # share an email or phone number were always allowed.
+    __table_args__ = (
+        db.Index("ix_customer_active_customer_id", "active", "customer_id"),
+        db.Index("ix_customer_email_key", "email_key", postgresql_using="hash"),
+        db.Index("ix_customer_phone_key", "phone_key", postgresql_using="hash"),
+        db.Index("ix_customer_change_position", "change_txid", "change_seq"),
+        {"sqlite_autoincrement": True},
+    )
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return "<customer_id=[{}] Firstname {} Lastname {} email_id {} address {} phone_number {} card_number {} active {}>".format(self.customer_id, self.firstname, self.lastname,
@@ -52,22 +140,238 @@ class Customer(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    def create_returning(self):
+        """
+        Creates a Customer in one round trip and returns the stored row as a dict
+
+        The row comes back from INSERT ... RETURNING where the database supports
+        it, otherwise it is assembled from the inserted values and primary key.
+        """
+        logger.info("Creating %s %s", self.firstname, self.lastname)
+        table = self.__table__
+        stmt = table.insert().values(**self.column_values())
+        if db.engine.dialect.implicit_returning:
+            row = dict(db.session.execute(stmt.returning(*table.c)).first())
+        else:
+            result = db.session.execute(stmt)
+            row = dict(result.last_inserted_params(), customer_id=result.inserted_primary_key[0])
+        db.session.commit()
+        return row
+
+    @classmethod
+    def update_returning(cls, customer_id, values, expected_version=None):
+        """
+        Updates a Customer in one round trip and returns the stored row as a dict
+
+        Databases without RETURNING read the row back inside the same
+        transaction. Returns None when no row matched, either because the
+        Customer does not exist or because its version is not expected_version.
+
+        Args:
+            customer_id (int): the id of the Customer to change
+            values (dict): the column values to write
+            expected_version (int): only update the row at this version
+        """
+        logger.info("Updating customer_id %s at version %s", customer_id, expected_version)
+        table = cls.__table__
+        stmt = table.update().where(table.c.customer_id == customer_id)
+        if expected_version is not None:
+            stmt = stmt.where(table.c.version == expected_version)
+        stmt = stmt.values(version=table.c.version + 1, **values)
+        if db.engine.dialect.implicit_returning:
+            row = db.session.execute(stmt.returning(*table.c)).first()
+        else:
+            result = db.session.execute(stmt)
+            row = None
+            if result.rowcount:
+                row = db.session.execute(
+                    table.select().where(table.c.customer_id == customer_id)
+                ).first()
+        db.session.commit()
+        if row is None:
+            return None
+        customer_cache().delete(customer_id)
+        return dict(row)
+
+    @classmethod
+    def exists(cls, customer_id):
+        """ Tells if there is a Customer with the given customer_id """
+        return db.session.query(cls.query.filter(cls.customer_id == customer_id).exists()).scalar()
+
+    @classmethod
+    def create_many(cls, customers, chunk_size=500):
+        """
+        Creates many Customers in a single transaction and returns their ids
+
+        On databases that support RETURNING the rows are written with one
+        multi-row INSERT per chunk, otherwise they are added to the session
+        and flushed together. Either way there is only one commit.
+
+        Args:
+            customers (list): the deserialized Customers to insert
+            chunk_size (int): the maximum number of rows per INSERT statement
+        """
+        logger.info("Creating %s Customers", len(customers))
+        customer_ids = []
+        if db.engine.dialect.implicit_returning:
+            table = cls.__table__
+            for start in range(0, len(customers), chunk_size):
+                rows = [customer.column_values() for customer in customers[start:start + chunk_size]]
+                result = db.session.execute(
+                    table.insert().values(rows).returning(table.c.customer_id)
+                )
+                customer_ids.extend(row[0] for row in result)
+        else:
+            for customer in customers:
+                customer.customer_id = None
+            db.session.add_all(customers)
+            db.session.flush()
+            customer_ids = [customer.customer_id for customer in customers]
+        db.session.commit()
+        return customer_ids
+
     def update(self):
 
         if not self.customer_id:
             raise DataValidationError("No fields provided to update")
+        customer_id = self.customer_id
         db.session.commit()
+        customer_cache().delete(customer_id)
+
+    @classmethod
+    def set_active(cls, active, customer_ids=None, filters=None, chunk_size=500, confirm=False):
+        """
+        Sets the active flag of every matching Customer and returns how many changed
+
+        The Customers are selected by id and/or by equality filters and are
+        updated with set based UPDATE statements in a single transaction.
+        Rows that already have the requested status are not rewritten.
+
+        Args:
+            active (bool): the new active status
+            customer_ids (list): the ids of the Customers to change
+            filters (dict): column values that the Customers must match
+            confirm (bool): allows filters that are prefix matches
+        """
+        logger.info("Setting active=%s on Customers %s %s", active, customer_ids, filters)
+        query = cls._bulk_query(customer_ids, filters, confirm).filter(cls.active != active)
+        count = 0
+        for chunk in cls._id_chunks(customer_ids, chunk_size):
+            if chunk is not None:
+                chunk_query = query.filter(cls.customer_id.in_(chunk))
+            else:
+                chunk_query = query
+            count += chunk_query.update(
+                {cls.active: active, cls.version: cls.version + 1}, synchronize_session=False
+            )
+        db.session.commit()
+        cls._invalidate(customer_ids, filters)
+        return count
+
+    @classmethod
+    def _bulk_query(cls, customer_ids, filters, confirm=False):
+        """Builds the query selecting the Customers for a bulk operation
+
+        Filters match exactly. A prefix such as "Jo*" is only taken with
+        confirm, as "*" alone would select every Customer.
+        """
+        filters = filters or {}
+        for name, value in filters.items():
+            if name not in cls.FILTER_COLUMNS:
+                raise DataValidationError("Invalid filter: " + name)
+            values = value if isinstance(value, (list, tuple)) else [value]
+            if not confirm and any(cls._is_prefix(name, x) for x in values):
+                raise DataValidationError(
+                    "Selecting Customers by the prefix {}={} requires confirm=true".format(name, value)
+                )
+        if customer_ids is None and not filters:
+            raise DataValidationError("Bulk operations require customer_ids or a filter")
+        return cls.find_by_criteria(filters)
+
+    @classmethod
+    def _invalidate(cls, customer_ids, filters):
+        """ Drops the cached copies of Customers changed by a bulk operation """
+        if filters or customer_ids is None:
+            customer_cache().clear()
+        else:
+            for customer_id in customer_ids:
+                customer_cache().delete(customer_id)
+
+    @staticmethod
+    def _id_chunks(customer_ids, chunk_size):
+        """ Splits an id list so each IN clause stays below the driver limits """
+        if customer_ids is None:
+            yield None
+            return
+        for start in range(0, len(customer_ids), chunk_size):
+            yield customer_ids[start:start + chunk_size]
 
     def delete(self):
         """ Removes a Customer from the data store """
         logger.info("Deleting %s %s", self.firstname, self.lastname)
+        customer_id = self.customer_id
         db.session.delete(self)
         db.session.commit()
+        customer_cache().delete(customer_id)
 
-    def serialize(self):
-        """ Serializes a Customer into a dictionary """
-        return {"customer_id": self.customer_id, "firstname": self.firstname, "lastname": self.lastname,
-        "email_id": self.email_id, "address": self.address, "phone_number": self.phone_number,"card_number":self.card_number,"active":self.active}
+    def serialize(self, fields=None):
+        """ Serializes a Customer into a dictionary of all or only the given fields """
+        return {name: getattr(self, name) for name in fields or self.FIELDS}
+
+    @classmethod
+    def select_fields(cls, names):
+        """Returns the FIELDS named in names, in order and always with customer_id
+
+        Raises a DataValidationError for a name that is not a field.
+        """
+        unknown = set(names) - set(cls.FIELDS)
+        if unknown:
+            raise DataValidationError("Invalid fields: {}".format(", ".join(sorted(unknown))))
+        return tuple(name for name in cls.FIELDS if name in names or name == "customer_id")
+
+    @classmethod
+    def serialize_row(cls, row):
+        """ Serializes a row returned by a write into the same dictionary as serialize() """
+        return {name: row[name] for name in cls.FIELDS}
+
+    def column_values(self):
+        """ Returns the writable column values of a deserialized Customer """
+        values = {name: getattr(self, name) for name in self.FIELDS if name != "customer_id"}
+        values.update(self.derived_values())
+        return values
+
+    @classmethod
+    def check_columns(cls, values):
+        """Raises a DataValidationError for column values the customer table could not store
+
+        deserialize() only checks that the fields are there, this catches the
+        nulls, types and lengths that would otherwise fail a whole INSERT.
+        """
+        for name, value in values.items():
+            column = cls.__table__.c[name]
+            if value is None:
+                if not column.nullable:
+                    raise DataValidationError("Invalid Customer: missing " + name)
+            elif isinstance(column.type, db.String):
+                if not isinstance(value, str):
+                    raise DataValidationError("Invalid {}: must be a string".format(name))
+                if column.type.length and len(value) > column.type.length:
+                    raise DataValidationError("Invalid {}: longer than {} characters".format(name, column.type.length))
+            elif name == "active" and not isinstance(value, bool):
+                raise DataValidationError("Invalid active: must be true or false")
+
+    def derived_values(self):
+        """ Returns the search text and lookup keys for the current names, email and phone number """
+        return {
+            "search_text": search.search_text(self.firstname, self.lastname, self.email_id, self.phone_number),
+            "email_key": search.email_key(self.email_id),
+            "phone_key": search.phone_key(self.phone_number, phone_country_code()),
+        }
+
+    def set_derived_values(self):
+        """ Brings the search text and lookup keys up to date """
+        for name, value in self.derived_values().items():
+            setattr(self, name, value)
 
     def deserialize(self, data):
         """
@@ -84,6 +388,7 @@ class Customer(db.Model):
             self.card_number = data["card_number"]
             self.email_id = data["email_id"]
             self.active =  data["active"]
+            self.set_derived_values()
         except AttributeError as error:
             raise DataValidationError(
                 "Invalid attribute: " + error.args[0]
@@ -99,14 +404,35 @@ class Customer(db.Model):
         return self
 
     @classmethod
-    def init_db(cls, app):
-        """ Initializes the database session """
+    def init_app(cls, app):
+        """Connects the model to the app without opening a database connection
+
+        The engine connects on the first query, and the tables are created
+        before the first request when DB_AUTO_CREATE is set.
+        """
         logger.info("Initializing database")
-        cls.app = app
+        app.extensions[CACHE_EXTENSION] = create_cache(
+            app.config.get("CUSTOMER_CACHE_SIZE", 0), app.config.get("CUSTOMER_CACHE_TTL", 0)
+        )
+        # Pooled engines record how long checkouts wait for a connection
+        options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+        if "pool_size" in options:
+            from service.pool import TimedQueuePool
+
+            options.setdefault("poolclass", TimedQueuePool)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        if app.config.get("DB_AUTO_CREATE", True):
+            app.before_first_request(db.create_all)
+
+    @classmethod
+    def init_db(cls, app):
+        """ Initializes the database session and creates the tables now """
+        if "sqlalchemy" not in app.extensions:
+            cls.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        if app.config.get("DB_AUTO_CREATE", True):
+            db.create_all()  # make our sqlalchemy tables
 
     @classmethod
     def all(cls):
@@ -114,12 +440,154 @@ class Customer(db.Model):
         logger.info("Processing all Customers")
         return cls.query.all()
 
+    @classmethod
+    def paginate(cls, limit, after=None, query=None):
+        """Returns a page of at most `limit` Customers ordered by customer_id
+
+        Args:
+            limit (int): the maximum number of Customers to return
+            after (int): only return Customers with a customer_id greater than this
+            query (Query): an optional filtered query to paginate over
+        """
+        logger.info("Processing page of %s Customers after %s", limit, after)
+        if query is None:
+            query = cls.query
+        if after is not None:
+            query = query.filter(cls.customer_id > after)
+        return query.order_by(cls.customer_id).limit(limit).all()
+
+    @classmethod
+    def paginate_rows(cls, limit, after=None, query=None, fields=None):
+        """Returns the same page as paginate() as plain rows instead of Customers
+
+        Each row holds the FIELDS, or only the given fields, followed by the
+        version. Skipping the ORM objects makes large pages much cheaper to
+        serialize, and selecting fewer columns reads less from the database.
+        """
+        if query is None:
+            query = cls.query
+        columns = [getattr(cls, name) for name in (fields or cls.FIELDS) + ("version",)]
+        return cls.paginate(limit, after=after, query=query.with_entities(*columns))
+
+    @classmethod
+    def serialize_rows(cls, rows, fields=None):
+        """ Serializes rows from paginate_rows() into the dictionaries of serialize() """
+        fields = fields or cls.FIELDS
+        return [dict(zip(fields, row)) for row in rows]
+
+    @classmethod
+    def stream(cls, batch_size=1000):
+        """Yields every Customer, fetching them in keyset batches
+
+        Only one batch is held in memory at a time, so the cost of walking
+        the whole table does not grow with the number of rows.
+
+        Args:
+            batch_size (int): the number of Customers fetched per query
+        """
+        logger.info("Streaming all Customers in batches of %s", batch_size)
+        after = None
+        while True:
+            batch = cls.paginate(batch_size, after=after)
+            if not batch:
+                return
+            for customer in batch:
+                yield customer
+            after = batch[-1].customer_id
+
+    @classmethod
+    def changes(cls, since=(0, 0), limit=100, fields=None):
+        """Returns the changes made after the position since, oldest first
+
+        Each change is a (position, operation, data) tuple, where position
+        is the (change_txid, change_seq) pair described in service.changes.
+        The operation is "upsert" with data holding the current Customer,
+        serialized with all or only the given fields, or "delete" with data
+        holding only its customer_id. A Customer written several times
+        appears once, at its latest change.
+
+        Args:
+            since (tuple): the highest position the caller has seen
+            limit (int): the maximum number of changes to return
+            fields (tuple): the fields to serialize, from select_fields()
+        """
+        logger.info("Processing changes after %s ...", since)
+        fields = fields or cls.FIELDS
+        # one horizon for both reads, so neither returns a change the other still holds back
+        horizon = changes.horizon(db.session.connection(mapper=cls.__mapper__))
+        query = cls.query.with_entities(
+            cls.change_txid, cls.change_seq, *[getattr(cls, name) for name in fields]
+        ).filter(changes.after(cls.change_txid, cls.change_seq, since))
+        if horizon is not None:
+            query = query.filter(cls.change_txid < horizon)
+        rows = query.order_by(cls.change_txid, cls.change_seq).limit(limit).all()
+        upserts = [((row[0], row[1]), "upsert", dict(zip(fields, row[2:]))) for row in rows]
+        deletes = [
+            ((change_txid, change_seq), "delete", {"customer_id": customer_id})
+            for customer_id, change_txid, change_seq in changes.tombstones(db.session, since, limit, horizon)
+        ]
+        return sorted(upserts + deletes, key=lambda change: change[0])[:limit]
+
+    @classmethod
+    def count(cls, criteria=None):
+        """Returns the number of Customers matching every given criterion
+
+        The total and the totals by active status are read from the counter
+        table kept by the database, other criteria are counted through
+        their indexes.
+
+        Args:
+            criteria (dict): column names mapped to the values to match, as for find_by_criteria
+        """
+        criteria = {name: value for name, value in (criteria or {}).items() if value is not None}
+        if set(criteria) <= {"active"} and not isinstance(criteria.get("active"), (list, tuple)):
+            totals = counts.totals(db.session)
+            if totals is not None:
+                if "active" in criteria:
+                    return totals[bool(criteria["active"])]
+                return totals[True] + totals[False]
+        logger.info("Counting Customers matching %s ...", criteria)
+        return cls.find_by_criteria(criteria).with_entities(func.count(cls.customer_id)).scalar()
+
+    @classmethod
+    def stats(cls):
+        """ Returns the total number of Customers and how many are active and inactive """
+        totals = counts.totals(db.session)
+        if totals is None:
+            totals = {active: cls.count({"active": active}) for active in (True, False)}
+        return {"total": totals[True] + totals[False], "active": totals[True], "inactive": totals[False]}
+
     @classmethod
     def remove_all(cls):
-        """ Removes all customers from the database (use for testing)  """
-        for customer in cls.query.all():
-            db.session.delete(customer)
+        """ Removes all customers from the database with a single DELETE """
+        logger.info("Removing all Customers")
+        count = cls.query.delete(synchronize_session=False)
         db.session.commit()
+        customer_cache().clear()
+        return count
+
+    @classmethod
+    def delete_many(cls, customer_ids=None, filters=None, chunk_size=500, confirm=False):
+        """
+        Deletes every matching Customer and returns how many were removed
+
+        Args:
+            customer_ids (list): the ids of the Customers to delete
+            filters (dict): column values that the Customers must match
+            confirm (bool): allows filters that are prefix matches
+        """
+        logger.info("Deleting Customers %s %s", customer_ids, filters)
+        query = cls._bulk_query(customer_ids, filters, confirm)
+        count = 0
+        for chunk in cls._id_chunks(customer_ids, chunk_size):
+            if chunk is not None:
+                chunk_query = query.filter(cls.customer_id.in_(chunk))
+            else:
+                chunk_query = query
+            count += chunk_query.delete(synchronize_session=False)
+        db.session.commit()
+        cls._invalidate(customer_ids, filters)
+        return count
 
     @classmethod
     def find(cls, customer_id):
@@ -129,6 +597,35 @@ class Customer(db.Model):
         return active_customers[0]
 
 
+    @classmethod
+    def find_versioned(cls, customer_id, fields=None):
+        """ Finds a Customer by it's customer_id, reading through the cache
+
+        Returns a (version, serialized Customer) tuple, or None when there
+        is no Customer with that customer_id. Given fields from
+        select_fields(), only those are serialized, and on a cache miss only
+        those columns are loaded (such partial Customers are not cached).
+        """
+        # sessions pinned to the primary must not see copies read from a replica
+        pinned = db.session.info.get("primary") or db.session.info.get("wrote")
+        entry = None if pinned else customer_cache().get(customer_id)
+        if entry is None:
+            logger.info("Processing cache miss for customer_id %s ...", customer_id)
+            query = cls.query
+            if fields is not None:
+                query = query.options(orm.load_only(*fields, "version"))
+            customer = query.get(customer_id)
+            if customer is None:
+                return None
+            if fields is not None:
+                return customer.version, customer.serialize(fields)
+            entry = (customer.version, customer.serialize())
+            customer_cache().set(customer_id, entry)
+        if fields is not None:
+            version, data = entry
+            return version, {name: data[name] for name in fields}
+        return entry
+
     @classmethod
     def find_or_404_int(cls, customer_id):
         """ Find a Customer by it's customer_id """
@@ -141,6 +638,89 @@ class Customer(db.Model):
     #     logger.info("Processing lookup or 404 for email_id  %s ...", id)
     #     return cls.query.get_or_404(id)
 
+    @classmethod
+    def find_by_criteria(cls, criteria):
+        """Returns a query for the Customers matching every given criterion
+
+        All of the criteria are combined with AND into a single WHERE clause.
+        A value may be a single value, a list of values that are matched
+        with IN, or for text columns a string ending in "*" that is matched
+        as a prefix. Criteria that are None are ignored.
+
+        Args:
+            criteria (dict): column names mapped to the values to match
+        """
+        logger.info("Processing criteria query for %s ...", criteria)
+        query = cls.query
+        for name, value in criteria.items():
+            if value is None:
+                continue
+            if name not in cls.FILTER_COLUMNS:
+                raise DataValidationError("Invalid filter: " + name)
+            column = getattr(cls, name)
+            values = value if isinstance(value, (list, tuple)) else [value]
+            exact = [x for x in values if not cls._is_prefix(name, x)]
+            terms = [
+                column.like(cls._escape_like(x[:-1]) + "%", escape="\\")
+                for x in values if cls._is_prefix(name, x)
+            ]
+            if len(exact) == 1:
+                terms.append(column == exact[0])
+            elif exact:
+                terms.append(column.in_(exact))
+            if terms:
+                query = query.filter(or_(*terms))
+        return query
+
+    @classmethod
+    def search(cls, query, limit=20, fields=None):
+        """Returns the rows of the Customers whose names, email or phone match query best
+
+        The match is case insensitive and may be anywhere in a value. Rows
+        whose first name starts with the term rank first, then those where
+        another value starts with it, then those containing it.
+
+        Args:
+            query (string): what the user typed
+            limit (int): the maximum number of rows to return
+            fields (tuple): the fields of each row, all FIELDS by default
+        """
+        term = search.search_term(query)
+        if not term:
+            raise DataValidationError("Invalid search: the search term is empty")
+        logger.info("Processing search for %s", term)
+        escaped = cls._escape_like(term)
+        rank = case(
+            [
+                (cls.search_text.like(escaped + "%", escape="\\"), 0),
+                (cls.search_text.like("% " + escaped + "%", escape="\\"), 1),
+            ],
+            else_=2,
+        )
+        matches = cls.query.filter(cls.search_text.like("%" + escaped + "%", escape="\\"))
+        session = db.session()
+        if session.get_bind(cls.__mapper__, matches.statement).dialect.name == "sqlite" and len(term) >= 3:
+            connection = session.connection(mapper=cls.__mapper__, clause=matches.statement)
+            if search.has_fts(connection):
+                # the trigram index finds the candidates, LIKE keeps the exact semantics
+                phrase = '"{}"'.format(term.replace('"', '""'))
+                candidates = text(
+                    "SELECT rowid FROM {0} WHERE {0} MATCH :phrase".format(search.FTS_TABLE)
+                ).bindparams(phrase=phrase)
+                matches = matches.filter(cls.customer_id.in_(candidates))
+        columns = [getattr(cls, name) for name in fields or cls.FIELDS]
+        return matches.with_entities(*columns).order_by(rank, cls.customer_id).limit(limit).all()
+
+    @classmethod
+    def _is_prefix(cls, name, value):
+        """ Tells if a text criterion is a prefix match """
+        return name in cls.TEXT_COLUMNS and isinstance(value, str) and value.endswith("*")
+
+    @staticmethod
+    def _escape_like(value):
+        """ Escapes the LIKE wildcards in a literal string """
+        return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
     @classmethod
     def find_by_firstname(cls, firstname):
         """Returns all Customers with the given firstname
@@ -149,7 +729,7 @@ class Customer(db.Model):
             name (string): the name of the Customers you want to match
         """
         logger.info("Processing first name query for %s  ...", firstname)
-        return cls.query.filter(cls.firstname == firstname and cls.active).all()
+        return cls.query.filter(cls.firstname == firstname).all()
 
     @classmethod
     def find_by_lastname(cls, lastname):
@@ -159,7 +739,31 @@ class Customer(db.Model):
             name (string): the name of the Customers you want to match
         """
         logger.info("Processing last name query for %s  ...", lastname)
-        return cls.query.filter(cls.lastname == lastname and cls.active).all()
+        return cls.query.filter(cls.lastname == lastname).all()
+
+    @classmethod
+    def find_by_email_key(cls, email_id):
+        """Returns the Customer with the given email address in any case, or None
+
+        When several Customers share it, the one created first is returned.
+        """
+        logger.info("Processing lookup for email %s ...", email_id)
+        key = search.email_key(email_id)
+        if key is None:
+            return None
+        return cls.query.filter(cls.email_key == key).order_by(cls.customer_id).first()
+
+    @classmethod
+    def find_by_phone_key(cls, phone_number):
+        """Returns the Customer with the given phone number in any format, or None
+
+        When several Customers share it, the one created first is returned.
+        """
+        logger.info("Processing lookup for phone number %s ...", phone_number)
+        key = search.phone_key(phone_number, phone_country_code())
+        if key is None:
+            return None
+        return cls.query.filter(cls.phone_key == key).order_by(cls.customer_id).first()
 
     @classmethod
     def find_by_emailID(cls, email_id):
@@ -169,7 +773,7 @@ class Customer(db.Model):
             name (string): the name of the Customers you want to match
         """
         logger.info("Processing name query for %s  ...", email_id)
-        return cls.query.filter(cls.email_id == email_id and cls.active).all()
+        return cls.query.filter(cls.email_id == email_id).all()
         
     @classmethod
     def find_by_phone_number(cls, phone_number):
@@ -179,7 +783,7 @@ class Customer(db.Model):
             name (string): the name of the Customers you want to match
         """
         logger.info("Processing name query for %s  ...", phone_number)
-        return cls.query.filter(cls.phone_number == phone_number and cls.active).all()
+        return cls.query.filter(cls.phone_number == phone_number).all()
 
     @classmethod
     def find_by_boolean(cls, active):
@@ -190,4 +794,45 @@ class Customer(db.Model):
         """
 
         logger.info("Processing boolena query for {}".format(active))
-        return cls.query.filter(cls.active == active).all()
\ No newline at end of file
+        return cls.query.filter(cls.active == active).all()
+
+
+def dispose_engines(app):
+    """Closes the pooled connections of every engine of the app
+
+    A forked worker must not reuse the connections its parent opened, the
+    engines open new ones on their next checkout.
+    """
+    for bind in [None] + list(app.config.get("SQLALCHEMY_BINDS") or {}):
+        db.get_engine(app, bind=bind).dispose()
+
+
+@event.listens_for(Customer, "before_insert")
+@event.listens_for(Customer, "before_update")
+def update_derived_values(mapper, connection, target):
+    """ Keeps the search text and lookup keys in step with the values they are made of """
+    target.set_derived_values()
+
+
+@event.listens_for(Customer.__table__, "after_create")
+def create_customer_extras(target, connection, **kwargs):
+    """ Builds the search index, the counter table, the change feed and the outbox along with the table """
+    # only the trigger DDL of the outbox is needed here, not its dispatcher
+    from service import outbox
+
+    search.create_index(connection)
+    counts.create_counts(connection)
+    changes.create_feed(connection)
+    outbox.create_outbox(connection, Customer.FIELDS)
+
+
+@event.listens_for(Customer.__table__, "after_drop")
+def clear_customer_cache(target, connection, **kwargs):
+    """ Cached Customers do not survive their table being dropped """
+    from service import outbox
+
+    customer_cache().clear()
+    search.drop_index(connection)
+    counts.drop_counts(connection)
+    changes.drop_feed(connection)
+    outbox.drop_outbox(connection)
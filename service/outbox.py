@@ -0,0 +1,358 @@
+"""
+Module: outbox
+
+Customer lifecycle webhooks delivered from a transactional outbox
+
+Triggers on the customer table write a customer.created, customer.updated,
+customer.activated, customer.deactivated or customer.deleted event into
+customer_events in the same transaction as the change, so an event exists
+exactly when its change committed. Writes pay for one extra row, never for
+a call to a subscriber, and while nobody subscribes no event is written.
+
+The Dispatcher runs in its own process:
+
+    flask webhooks-dispatch
+
+It posts the events to every URL in WEBHOOK_URLS as JSON arrays of up to
+WEBHOOK_BATCH_SIZE events, several batches and subscribers at a time on a
+pool of WEBHOOK_CONCURRENCY threads that keep their connections open. Each
+subscriber has a cursor in webhook_subscribers that only moves past events
+it acknowledged with a 2xx status, a failing subscriber is retried with
+exponential backoff, and events every subscriber has received are deleted.
+Delivery is at least once, a resent event keeps its event_id, which
+subscribers can use to drop duplicates.
+
+Events are read in order of (txid, event_id), the position the change feed
+uses (see service.changes): on Postgres txid is the writing transaction, and
+only events of transactions below the horizon are read, so a cursor never
+moves past an event that is still to commit.
+"""
+import json
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlsplit
+from sqlalchemy import MetaData, Table, Column, Index, Integer, BigInteger, String, Text, DateTime, select, text
+from service import changes
+from service.encoders import dumps
+
+logger = logging.getLogger("flask.app")
+
+# The outbox tables live outside of the models metadata, they are created and
+# dropped along with the customer table they follow
+metadata = MetaData()
+
+customer_events = Table(
+    "customer_events",
+    metadata,
+    Column("event_id", Integer, primary_key=True),
+    Column("customer_id", Integer, nullable=False),
+    Column("event_type", String(16), nullable=False),
+    # the Customer as it was written, as a JSON object
+    Column("payload", Text, nullable=False),
+    # UTC
+    Column("created_at", DateTime, nullable=False),
+    # the writing transaction on Postgres, 0 elsewhere
+    Column("txid", BigInteger, nullable=False, server_default="0"),
+    Index("ix_customer_events_position", "txid", "event_id"),
+    sqlite_autoincrement=True,
+)
+
+webhook_subscribers = Table(
+    "webhook_subscribers",
+    metadata,
+    Column("url", String(255), primary_key=True),
+    # the position of the last event the subscriber acknowledged
+    Column("event_id", BigInteger, nullable=False),
+    Column("txid", BigInteger, nullable=False, server_default="0"),
+)
+
+POSTGRES_DDL = (
+    "CREATE OR REPLACE FUNCTION customer_events_trigger() RETURNS trigger AS $$ "
+    "DECLARE target customer%ROWTYPE; kind text; BEGIN "
+    "IF NOT EXISTS (SELECT 1 FROM webhook_subscribers) THEN RETURN NULL; END IF; "
+    "IF TG_OP = 'DELETE' THEN target := OLD; kind := 'deleted'; "
+    "ELSIF TG_OP = 'INSERT' THEN target := NEW; kind := 'created'; "
+    "ELSIF OLD.active IS DISTINCT FROM NEW.active THEN "
+    "target := NEW; kind := CASE WHEN NEW.active THEN 'activated' ELSE 'deactivated' END; "
+    "ELSE target := NEW; kind := 'updated'; END IF; "
+    "INSERT INTO customer_events (customer_id, event_type, payload, created_at, txid) "
+    "VALUES (target.customer_id, kind, json_build_object({json})::text, now() AT TIME ZONE 'utc', txid_current()); "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS customer_events ON customer",
+    "CREATE TRIGGER customer_events AFTER INSERT OR DELETE ON customer "
+    "FOR EACH ROW EXECUTE PROCEDURE customer_events_trigger()",
+    "DROP TRIGGER IF EXISTS customer_events_update ON customer",
+    "CREATE TRIGGER customer_events_update AFTER UPDATE ON customer "
+    "FOR EACH ROW WHEN (({old}) IS DISTINCT FROM ({new})) EXECUTE PROCEDURE customer_events_trigger()",
+)
+
+SQLITE_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS customer_events_insert AFTER INSERT ON customer "
+    "WHEN EXISTS (SELECT 1 FROM webhook_subscribers) BEGIN "
+    "INSERT INTO customer_events (customer_id, event_type, payload, created_at) "
+    "VALUES (new.customer_id, 'created', json_object({new_json}), CURRENT_TIMESTAMP); END",
+    "CREATE TRIGGER IF NOT EXISTS customer_events_update AFTER UPDATE ON customer "
+    "WHEN EXISTS (SELECT 1 FROM webhook_subscribers) AND ({changed}) BEGIN "
+    "INSERT INTO customer_events (customer_id, event_type, payload, created_at) "
+    "VALUES (new.customer_id, CASE WHEN old.active IS new.active THEN 'updated' "
+    "WHEN new.active THEN 'activated' ELSE 'deactivated' END, json_object({new_json}), CURRENT_TIMESTAMP); END",
+    "CREATE TRIGGER IF NOT EXISTS customer_events_delete AFTER DELETE ON customer "
+    "WHEN EXISTS (SELECT 1 FROM webhook_subscribers) BEGIN "
+    "INSERT INTO customer_events (customer_id, event_type, payload, created_at) "
+    "VALUES (old.customer_id, 'deleted', json_object({old_json}), CURRENT_TIMESTAMP); END",
+)
+
+
+def sqlite_json(row, fields):
+    """ Returns the json_object() arguments that serialize fields of the trigger row """
+    pairs = []
+    for name in fields:
+        value = "{}.{}".format(row, name)
+        if name == "active":
+            value = "json(CASE WHEN {} THEN 'true' ELSE 'false' END)".format(value)
+        pairs.append("'{}', {}".format(name, value))
+    return ", ".join(pairs)
+
+
+def create_outbox(connection, fields):
+    """Creates the outbox tables and the triggers that write the events
+
+    Args:
+        fields (tuple): the Customer columns that events carry, customer_id first
+
+    Returns False when the database has no triggers this module knows.
+    """
+    # only changes to what an event carries are worth an event
+    watched = [name for name in fields if name != "customer_id"]
+    if connection.dialect.name == "postgresql":
+        statements = [
+            ddl.format(
+                json=", ".join("'{0}', target.{0}".format(name) for name in fields),
+                old=", ".join("OLD." + name for name in watched),
+                new=", ".join("NEW." + name for name in watched),
+            )
+            for ddl in POSTGRES_DDL
+        ]
+    elif connection.dialect.name == "sqlite":
+        statements = [
+            ddl.format(
+                new_json=sqlite_json("new", fields),
+                old_json=sqlite_json("old", fields),
+                changed=" OR ".join("old.{0} IS NOT new.{0}".format(name) for name in watched),
+            )
+            for ddl in SQLITE_DDL
+        ]
+    else:
+        return False
+    metadata.create_all(connection)
+    for statement in statements:
+        connection.execute(text(statement))
+    return True
+
+
+def drop_outbox(connection):
+    """ Drops the outbox tables, the triggers go with the customer table """
+    metadata.drop_all(connection, checkfirst=True)
+
+
+######################################################################
+#  D E L I V E R Y   (only the dispatcher process needs http.client)
+######################################################################
+_local = threading.local()
+
+
+def post(url, body, timeout):
+    """Posts a JSON body to url and returns the response status
+
+    Every thread keeps one open connection per host, a connection the
+    server has closed since its last use is replaced once.
+    """
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+
+    parts = urlsplit(url)
+    path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+    headers = {"Content-Type": "application/json", "User-Agent": "customers-webhooks"}
+    connections = _local.__dict__.setdefault("connections", {})
+    key = (parts.scheme, parts.netloc)
+    for attempt in (1, 2):
+        reused = key in connections
+        if not reused:
+            factory = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+            connections[key] = factory(parts.netloc, timeout=timeout)
+        connection = connections[key]
+        try:
+            connection.request("POST", path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, HTTPException):
+            connection.close()
+            del connections[key]
+            if not reused or attempt == 2:
+                raise
+    return None  # pragma: no cover
+
+
+class Dispatcher:
+    """
+    Delivers the outbox to the webhook subscribers
+
+    Args:
+        engine: the engine of the database holding the outbox
+        urls (list): the subscriber URLs, events are only kept for these
+        batch_size (int): the most events posted in one request
+        concurrency (int): the number of requests in flight at once
+        timeout (float): seconds to wait for a subscriber to respond
+        backoff (float): seconds before the first retry, doubled on every failure
+        max_backoff (float): the longest wait between retries
+    """
+
+    def __init__(self, engine, urls, batch_size=100, concurrency=8, timeout=5, backoff=1, max_backoff=300):
+        self.engine = engine
+        self.urls = list(urls)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.pool = ThreadPoolExecutor(concurrency, thread_name_prefix="webhooks")
+        # subscriber url -> (consecutive failures, monotonic time of the next attempt)
+        self.retries = {}
+
+    @classmethod
+    def from_config(cls, config, engine):
+        """ Creates a Dispatcher from the WEBHOOK_* settings of an app """
+        return cls(
+            engine,
+            [url.strip() for url in config.get("WEBHOOK_URLS", "").split(",") if url.strip()],
+            batch_size=config.get("WEBHOOK_BATCH_SIZE", 100),
+            concurrency=config.get("WEBHOOK_CONCURRENCY", 8),
+            timeout=config.get("WEBHOOK_TIMEOUT", 5),
+            backoff=config.get("WEBHOOK_BACKOFF", 1),
+            max_backoff=config.get("WEBHOOK_MAX_BACKOFF", 300),
+        )
+
+    def sync_subscribers(self):
+        """Registers the configured subscribers and forgets the others
+
+        A new subscriber receives the events written from now on.
+        """
+        table = webhook_subscribers
+        with self.engine.begin() as connection:
+            known = {row[0] for row in connection.execute(select([table.c.url]))}
+            query = select([customer_events.c.txid, customer_events.c.event_id])
+            horizon = changes.horizon(connection)
+            if horizon is not None:
+                query = query.where(customer_events.c.txid < horizon)
+            latest = connection.execute(
+                query.order_by(customer_events.c.txid.desc(), customer_events.c.event_id.desc()).limit(1)
+            ).first() or (0, 0)
+            for url in set(self.urls) - known:
+                logger.info("Subscribing %s to Customer events", url)
+                connection.execute(table.insert().values(url=url, txid=latest[0], event_id=latest[1]))
+            stale = known - set(self.urls)
+            if stale:
+                connection.execute(table.delete().where(table.c.url.in_(stale)))
+
+    def deliver(self, url, batch):
+        """ Posts a batch of events to a subscriber and tells if it was acknowledged """
+        from http.client import HTTPException
+
+        body = dumps([
+            {
+                "event_id": row["event_id"],
+                "type": "customer." + row["event_type"],
+                "occurred_at": row["created_at"].isoformat() + "Z",
+                "customer": json.loads(row["payload"]),
+            }
+            for row in batch
+        ])
+        try:
+            code = post(url, body, self.timeout)
+        except (OSError, HTTPException) as error:
+            logger.warning("Webhook %s failed: %s", url, error)
+            return False
+        if not 200 <= code < 300:
+            logger.warning("Webhook %s answered %s", url, code)
+            return False
+        return True
+
+    def run_once(self):
+        """Sends every due subscriber its next batches, and returns how many events were delivered
+
+        Up to concurrency batches are read for each subscriber and sent at
+        once. A cursor only moves over the batches acknowledged in a row
+        from its start, later batches that got through are sent again.
+        """
+        now = time.monotonic()
+        jobs = []
+        events = customer_events.c
+        with self.engine.connect() as connection:
+            horizon = changes.horizon(connection)
+            for url, txid, event_id in connection.execute(
+                select([webhook_subscribers.c.url, webhook_subscribers.c.txid, webhook_subscribers.c.event_id])
+            ).fetchall():
+                if self.retries.get(url, (0, 0))[1] > now:
+                    continue
+                query = customer_events.select().where(changes.after(events.txid, events.event_id, (txid, event_id)))
+                if horizon is not None:
+                    query = query.where(events.txid < horizon)
+                rows = connection.execute(
+                    query.order_by(events.txid, events.event_id).limit(self.batch_size * self.concurrency)
+                ).fetchall()
+                batches = [rows[start:start + self.batch_size] for start in range(0, len(rows), self.batch_size)]
+                jobs.append((url, batches, [self.pool.submit(self.deliver, url, batch) for batch in batches]))
+        delivered = 0
+        with self.engine.begin() as connection:
+            for url, batches, futures in jobs:
+                acknowledged = [future.result() for future in futures]
+                done = batches[:acknowledged.index(False)] if False in acknowledged else batches
+                if done:
+                    delivered += sum(len(batch) for batch in done)
+                    connection.execute(
+                        webhook_subscribers.update()
+                        .where(webhook_subscribers.c.url == url)
+                        .values(txid=done[-1][-1]["txid"], event_id=done[-1][-1]["event_id"])
+                    )
+                if False in acknowledged:
+                    self.retry_later(url)
+                else:
+                    self.retries.pop(url, None)
+            self.prune(connection)
+        return delivered
+
+    def retry_later(self, url):
+        """ Schedules the next attempt of a failing subscriber with exponential backoff and jitter """
+        failures = self.retries.get(url, (0, 0))[0] + 1
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1)) * random.uniform(0.5, 1)
+        logger.info("Retrying webhook %s in %.1f seconds", url, delay)
+        self.retries[url] = (failures, time.monotonic() + delay)
+
+    @staticmethod
+    def prune(connection):
+        """ Deletes the events that every subscriber has received """
+        table = webhook_subscribers
+        oldest = connection.execute(
+            select([table.c.txid, table.c.event_id]).order_by(table.c.txid, table.c.event_id).limit(1)
+        ).first()
+        query = customer_events.delete()
+        if oldest is not None:
+            query = query.where(~changes.after(customer_events.c.txid, customer_events.c.event_id, tuple(oldest)))
+        connection.execute(query)
+
+    def run(self, stop, poll_interval=1):
+        """ Delivers events until stop is set, waiting poll_interval seconds whenever there are none """
+        self.sync_subscribers()
+        while not stop.is_set():
+            try:
+                delivered = self.run_once()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Webhook dispatch failed: %s", error)
+                delivered = 0
+            if not delivered:
+                stop.wait(poll_interval)
+        self.pool.shutdown()
@@ -0,0 +1,92 @@
+"""
+Module: pool
+
+Database connection pool with live statistics
+
+TimedQueuePool is a QueuePool that records how long every checkout waited
+for a connection, so it is visible when gunicorn workers queue for the
+database. pool_stats() reports the state of a worker's pool.
+"""
+import os
+import time
+import threading
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds in seconds of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """ A thread safe histogram with cumulative buckets """
+
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """ Records one value """
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+
+    def snapshot(self):
+        """ Returns the cumulative bucket counts, the count and the sum """
+        with self._lock:
+            cumulative, total = {}, 0
+            for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+                total += count
+                cumulative[str(bound)] = total
+            return {"buckets": cumulative, "count": self.count, "sum": self.sum}
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that measures how long checkouts wait for a connection """
+
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kwargs):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kwargs)
+        # QueuePool keeps the limit private, pool_stats() reports it from here
+        self.max_overflow = max_overflow
+        self.wait_time = Histogram()
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.wait_time.observe(time.perf_counter() - start)
+
+
+def pool_stats(engine):
+    """ Returns the live statistics of an engine's connection pool """
+    pool = engine.pool
+    stats = {"pid": os.getpid(), "pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                # overflow() counts up from -size while the pool fills
+                "overflow": max(pool.overflow(), 0),
+                "timeout": pool.timeout(),
+            }
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats["max_overflow"] = pool.max_overflow
+        stats["timeouts"] = pool.timeouts
+        stats["wait_seconds"] = pool.wait_time.snapshot()
+    return stats
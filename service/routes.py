@@ -4,27 +4,37 @@ My Service
 Describe what your service does here
 """
 
+import io
 import os
 import sys
+import json
+import base64
+import hashlib
 import logging
 import secrets
-from flask import Flask, jsonify, request, url_for, make_response, abort
+import time
+from flask import Blueprint, Flask, Response, current_app, render_template, jsonify, request, url_for, make_response, abort, stream_with_context
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from . import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag, unquote_etag
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Customer, DataValidationError, DatabaseConnectionError
+from service.compression import identity_etag
+from service.encoders import json_response
+from service.models import Customer, DataValidationError, DatabaseConnectionError, customer_cache, db, REPLICA_BIND
 
-# Import Flask application
-from . import app
+# The routes are registered on the app by service.create_app()
+bp = Blueprint("customers", __name__)
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
+@bp.route("/")
 def index():
     """ Root URL response """
     # return (
@@ -32,12 +42,56 @@ def index():
     #     status.HTTP_200_OK,
     # )
     """ Index page """
-    return app.send_static_file('index.html')
+    return render_template('index.html')
+
+######################################################################
+# READ-YOUR-WRITES STICKINESS FOR THE READ REPLICA
+######################################################################
+PRIMARY_COOKIE = "read_primary_until"
+
+@bp.before_app_request
+def route_reads_after_recent_write():
+    """ Reads from the primary while the client's last write is recent """
+    if REPLICA_BIND not in (current_app.config.get("SQLALCHEMY_BINDS") or {}):
+        return
+    try:
+        primary_until = float(request.cookies.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        primary_until = 0
+    if primary_until > time.time():
+        db.session.info["primary"] = True
+
+
+@bp.after_app_request
+def remember_recent_write(response):
+    """ Tells the client to read from the primary for a while after a write """
+    if REPLICA_BIND in (current_app.config.get("SQLALCHEMY_BINDS") or {}) and db.session.info.get("wrote"):
+        window = current_app.config["REPLICA_STICKY_SECONDS"]
+        response.set_cookie(PRIMARY_COOKIE, str(time.time() + window), max_age=int(window) + 1, httponly=True)
+    return response
+
+######################################################################
+# GET CACHE STATISTICS
+######################################################################
+@bp.route("/stats/cache")
+def cache_stats():
+    """ Returns the counters of this worker's Customer cache """
+    return jsonify(customer_cache().stats()), status.HTTP_200_OK
+
+######################################################################
+# GET CONNECTION POOL STATISTICS
+######################################################################
+@bp.route("/stats/pool")
+def connection_pool_stats():
+    """ Returns the state of this worker's database connection pool """
+    from service.pool import pool_stats
+
+    return jsonify(pool_stats(db.engine)), status.HTTP_200_OK
 
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
-api = Api(app,
+api = Api(bp,
           version='1.0.0',
           title='Customer REST API Service',
           description='This is a Customer server',
@@ -76,11 +130,39 @@ customer_model = api.inherit(
 
 
 customer_args = reqparse.RequestParser()
-customer_args.add_argument('firstname', type=str, required=False, location='args', help='List Customers by first name')
-customer_args.add_argument('lastname', type=str, required=False, location='args', help='List Customers by last name')
-customer_args.add_argument('email_id', type=str, required=False, location='args', help='List Customers by email id')
-customer_args.add_argument('phone_number', type=str, required=False, location='args', help='List Customers by state')
+# Repeat a text filter to match any of its values, end it with * to match a prefix
+customer_args.add_argument('firstname', type=str, action='append', required=False, location='args', help='List Customers by first name')
+customer_args.add_argument('lastname', type=str, action='append', required=False, location='args', help='List Customers by last name')
+customer_args.add_argument('email_id', type=str, action='append', required=False, location='args', help='List Customers by email id')
+customer_args.add_argument('phone_number', type=str, action='append', required=False, location='args', help='List Customers by phone number')
 customer_args.add_argument('active', type=inputs.boolean, required=False, location='args', help='List active Customers')
+customer_args.add_argument('limit', type=inputs.positive, required=False, location='args', help='Maximum number of Customers per page')
+customer_args.add_argument('after', type=str, required=False, location='args', help='Opaque cursor returned as the next page link')
+customer_args.add_argument('fields', type=str, required=False, location='args', help='Comma separated fields to return, customer_id is always included')
+customer_args.add_argument('count', type=inputs.boolean, required=False, location='args', help='Also return the number of matching Customers in X-Total-Count')
+
+fields_args = reqparse.RequestParser()
+fields_args.add_argument('fields', type=str, required=False, location='args', help='Comma separated fields to return, customer_id is always included')
+
+bulk_args = reqparse.RequestParser()
+bulk_args.add_argument('firstname', type=str, required=False, location='args', help='Select Customers by first name')
+bulk_args.add_argument('lastname', type=str, required=False, location='args', help='Select Customers by last name')
+bulk_args.add_argument('email_id', type=str, required=False, location='args', help='Select Customers by email id')
+bulk_args.add_argument('phone_number', type=str, required=False, location='args', help='Select Customers by phone number')
+
+bulk_model = api.model('CustomerSelection', {
+    'customer_ids': fields.List(fields.Integer, required=False,
+                                description='The ids of the Customers to select'),
+})
+
+confirm_args = bulk_args.copy()
+confirm_args.add_argument('confirm', type=inputs.boolean, required=False, location='args', default=False,
+                          help='Must be true to select Customers by a prefix such as Jo*')
+
+delete_args = bulk_args.copy()
+delete_args.add_argument('confirm', type=inputs.boolean, required=False, location='args', default=False,
+                         help='Must be true to delete every Customer, or the Customers matching a prefix such as Jo*')
+
 
 ######################################################################
 # Special Error Handlers
@@ -89,13 +171,34 @@ customer_args.add_argument('active', type=inputs.boolean, required=False, locati
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
     message = str(error)
-    app.logger.error(message)
+    current_app.logger.error(message)
     return {
         'status_code': status.HTTP_400_BAD_REQUEST,
         'error': 'Bad Request',
         'message': message
     }, status.HTTP_400_BAD_REQUEST
 
+@api.errorhandler(StaleDataError)
+def precondition_failed(error):
+    """ Handles writes that lost an optimistic concurrency race """
+    message = str(error)
+    current_app.logger.warning(message)
+    return {
+        'status_code': status.HTTP_412_PRECONDITION_FAILED,
+        'error': 'Precondition Failed',
+        'message': 'The Customer was changed by another request'
+    }, status.HTTP_412_PRECONDITION_FAILED
+
+@api.errorhandler(OperationalError)
+def database_unavailable(error):
+    """ Handles a database that cannot be reached, so clients retry later """
+    current_app.logger.critical(str(error))
+    return {
+        'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+        'error': 'Service Unavailable',
+        'message': 'The database is not available'
+    }, status.HTTP_503_SERVICE_UNAVAILABLE
+
 # @api.errorhandler(DatabaseConnectionError)
 # def database_connection_error(error):
 #     """ Handles Database Errors from connection attempts """
@@ -127,51 +230,54 @@ class CustomerCollection(Resource):
     # LIST ALL CUSTOMERS
     #------------------------------------------------------------------
     @api.doc('list_customers')
+    @api.response(200, 'Success', [customer_model])
+    @api.response(304, 'The page still matches the ETag in If-None-Match')
     @api.expect(customer_args, validate=True)
-    @api.marshal_list_with(customer_model)
-
     def get(self):
         """
-        Retrieve a single Customer with the requested values
+        Retrieve a page of Customers matching every requested value
         """
-        app.logger.info('Request to list Customers...')
+        current_app.logger.info('Request to list Customers...')
         args = customer_args.parse_args()
+        criteria = {name: args[name] for name in Customer.FILTER_COLUMNS if args[name] is not None}
+        current_app.logger.info("Request for Customers matching %s", criteria)
+        limit = min(args['limit'] or current_app.config['DEFAULT_PAGE_SIZE'], current_app.config['MAX_PAGE_SIZE'])
+        after = decode_cursor(args['after']) if args['after'] else None
+        # fetch one extra row to find out if there is a next page
+        fields = requested_fields(args['fields'])
+        customer = Customer.paginate_rows(limit + 1, after=after, query=Customer.find_by_criteria(criteria), fields=fields)
+        headers = {"ETag": list_etag(customer, fields)}
+        if if_none_match(headers["ETag"]):
+            return json_response([], status.HTTP_304_NOT_MODIFIED, headers)
+        # counted after the 304, which has no use for the total
+        if args['count']:
+            headers["X-Total-Count"] = str(Customer.count(criteria))
+        if len(customer) > limit:
+            customer = customer[:limit]
+            cursor = encode_cursor(customer[-1].customer_id)
+            if fields:
+                criteria["fields"] = args['fields']
+            next_url = api.url_for(CustomerCollection, limit=limit, after=cursor, _external=True, **criteria)
+            headers["Link"] = '<{}>; rel="next"'.format(next_url)
+            headers["X-Next-Cursor"] = cursor
+        # the rows are encoded as they are, customer_model only documents them
+        return json_response(Customer.serialize_rows(customer, fields), status.HTTP_200_OK, headers)
 
-        if args['email_id']:
-            app.logger.info("Request for Customer with id: %s", args['email_id'])
-            customer = Customer.find_by_emailID(args['email_id'])
-            customer_list = [x.serialize() for x in customer]
-            return customer_list, status.HTTP_200_OK
-        
-        elif args['firstname']:
-            app.logger.info("Request for Customer with firstname: %s", args['firstname'])
-            customer = Customer.find_by_firstname(args['firstname'])
-            customer_list = [x.serialize() for x in customer]
-            return customer_list, status.HTTP_200_OK
-            
-        elif args['lastname']:
-            app.logger.info("Request for Customer with lastname: %s", args['lastname'])
-            customer = Customer.find_by_lastname(args['lastname'])
-            customer_list = [x.serialize() for x in customer]
-            return customer_list, status.HTTP_200_OK
-        
-        elif args['phone_number']:
-            app.logger.info("Request for Customer with phone_number: %s", args['phone_number'])
-            customer = Customer.find_by_phone_number(args['phone_number'])
-            customer_list = [x.serialize() for x in customer]
-            return customer_list, status.HTTP_200_OK
-
-        elif args['active']:
-            app.logger.info("Request for Customer with active status: %s", args['active'])
-            customer = Customer.find_by_boolean(args['active'])
-            customer_list = [x.serialize() for x in customer]
-            return customer_list, status.HTTP_200_OK
-
-        else:
-            app.logger.info("Request for all customers")
-            customer = Customer.all()
-            customer_list = [x.serialize() for x in customer]
-            return customer_list, status.HTTP_200_OK
+    #------------------------------------------------------------------
+    # COUNT CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('count_customers')
+    @api.response(200, 'The number of matching Customers is in X-Total-Count')
+    @api.expect(customer_args, validate=True)
+    def head(self):
+        """
+        Count the Customers matching every requested value without listing them
+        """
+        args = customer_args.parse_args()
+        criteria = {name: args[name] for name in Customer.FILTER_COLUMNS if args[name] is not None}
+        current_app.logger.info("Request to count Customers matching %s", criteria)
+        headers = {"X-Total-Count": str(Customer.count(criteria))}
+        return Response(status=status.HTTP_200_OK, headers=headers, mimetype="application/json")
 
     #------------------------------------------------------------------
     # ADD A NEW CUSTOMER
@@ -187,18 +293,374 @@ class CustomerCollection(Resource):
         Creates a Customer
         This endpoint will create a Customer based the data in the body that is posted
         """
-        app.logger.info("Request to create a customer")
+        current_app.logger.info("Request to create a customer")
         check_content_type("application/json")
         customer = Customer()
-        app.logger.debug('Payload = %s', api.payload)
+        current_app.logger.debug('Payload = %s', api.payload)
         customer.deserialize(api.payload)
-        customer.create()
-        message = customer.serialize()
-        location_url = api.url_for(CustomerResource, customer_id=customer.customer_id, _external=True)
-        app.logger.info("Customer with ID [%s] created.", customer.customer_id)
-        return message, status.HTTP_201_CREATED, {"Location": location_url}
+        row = customer.create_returning()
+        location_url = api.url_for(CustomerResource, customer_id=row["customer_id"], _external=True)
+        current_app.logger.info("Customer with ID [%s] created.", row["customer_id"])
+        headers = {"Location": location_url, "ETag": customer_etag(row["version"])}
+        return Customer.serialize_row(row), status.HTTP_201_CREATED, headers
+
+    #------------------------------------------------------------------
+    # DELETE MANY CUSTOMERS
+    #------------------------------------------------------------------
+    @api.doc('delete_customers_bulk')
+    @api.expect(delete_args, bulk_model)
+    @api.response(200, 'Customers deleted')
+    @api.response(400, 'No Customers were selected')
+    def delete(self):
+        """
+        Delete many Customers
+        This endpoint deletes every Customer matching the ids in the body and/or
+        the query filters, which match exactly. Deleting every Customer, or
+        selecting them by a prefix such as Jo*, requires confirm=true.
+        """
+        customer_ids, filters = bulk_selection()
+        confirm = delete_args.parse_args()['confirm']
+        if customer_ids is None and not filters:
+            if not confirm:
+                raise DataValidationError("Deleting every Customer requires confirm=true")
+            current_app.logger.info("Request to delete all customers")
+            count = Customer.remove_all()
+        else:
+            current_app.logger.info("Request to delete customers %s %s", customer_ids, filters)
+            count = Customer.delete_many(customer_ids, filters, confirm=confirm)
+        return {'deleted': count}, status.HTTP_200_OK
+
+
+
+######################################################################
+# PATH: /customers/batch
+######################################################################
+@api.route("/customers/batch")
+class CustomerBatch(Resource):
+    """ Creates many Customers in one request """
+    @api.doc('create_customers_batch')
+    @api.response(201, 'All Customers created successfully')
+    @api.response(207, 'Some Customers were not valid, see the per item status')
+    @api.response(400, 'The posted data was not a list of Customers, or no Customer in it could be created')
+    @api.expect([create_model])
+    def post(self):
+        """
+        Creates a batch of Customers
+        Every valid Customer in the posted list is inserted in one transaction
+        and the response reports the status of each item by its index
+        """
+        check_content_type("application/json")
+        payload = api.payload
+        if not isinstance(payload, list):
+            raise DataValidationError("Invalid batch: body of request must be a list of Customers")
+        if len(payload) > current_app.config['MAX_BATCH_SIZE']:
+            raise DataValidationError(
+                "Invalid batch: at most {} Customers per request".format(current_app.config['MAX_BATCH_SIZE'])
+            )
+        current_app.logger.info("Request to create %s customers", len(payload))
+        results = [None] * len(payload)
+        valid = []
+        for index, data in enumerate(payload):
+            try:
+                customer = Customer().deserialize(data)
+                Customer.check_columns(customer.column_values())
+                valid.append((index, customer))
+            except DataValidationError as error:
+                results[index] = batch_error(index, str(error))
+        if payload and not valid:
+            return results, status.HTTP_400_BAD_REQUEST
+        try:
+            customer_ids = Customer.create_many(
+                [customer for _, customer in valid], chunk_size=current_app.config['INSERT_CHUNK_SIZE']
+            )
+        except (IntegrityError, DataError) as error:
+            # a constraint the checks above do not know, nothing was written
+            db.session.rollback()
+            current_app.logger.error("Batch rejected by the database: %s", error.orig)
+            message = "Not created, the database rejected the batch: {}".format(error.orig)
+            for index, _ in valid:
+                results[index] = batch_error(index, message)
+            return results, status.HTTP_400_BAD_REQUEST
+        for (index, _), customer_id in zip(valid, customer_ids):
+            results[index] = {
+                'index': index,
+                'status': status.HTTP_201_CREATED,
+                'customer_id': customer_id
+            }
+        current_app.logger.info("Created %s of %s customers", len(customer_ids), len(payload))
+        code = status.HTTP_201_CREATED if len(valid) == len(payload) else status.HTTP_207_MULTI_STATUS
+        return results, code
+
+######################################################################
+# PATH: /customers/activate and /customers/deactivate
+######################################################################
+@api.route("/customers/deactivate")
+class BulkDeactivateResource(Resource):
+    """ Deactivate action on many Customers """
+    @api.doc('deactivate_customers')
+    @api.expect(confirm_args, bulk_model)
+    @api.response(400, 'No Customers were selected')
+    def put(self):
+        """
+        Deactivate many Customers
+        This endpoint deactivates every Customer matching the ids in the body and/or the query filters,
+        which match exactly. Selecting Customers by a prefix such as Jo* requires confirm=true.
+        """
+        customer_ids, filters = bulk_selection()
+        current_app.logger.info('Request to deactivate customers %s %s', customer_ids, filters)
+        count = Customer.set_active(False, customer_ids, filters, confirm=confirm_args.parse_args()['confirm'])
+        return {'updated': count}, status.HTTP_200_OK
+
+
+@api.route("/customers/activate")
+class BulkActivateResource(Resource):
+    """ Activate action on many Customers """
+    @api.doc('activate_customers')
+    @api.expect(confirm_args, bulk_model)
+    @api.response(400, 'No Customers were selected')
+    def put(self):
+        """
+        Activate many Customers
+        This endpoint activates every Customer matching the ids in the body and/or the query filters,
+        which match exactly. Selecting Customers by a prefix such as Jo* requires confirm=true.
+        """
+        customer_ids, filters = bulk_selection()
+        current_app.logger.info('Request to activate customers %s %s', customer_ids, filters)
+        count = Customer.set_active(True, customer_ids, filters, confirm=confirm_args.parse_args()['confirm'])
+        return {'updated': count}, status.HTTP_200_OK
+
+######################################################################
+# PATH: /customers/search
+######################################################################
+search_args = reqparse.RequestParser()
+search_args.add_argument('q', type=str, required=True, location='args', help='Part of a name, email or phone number')
+search_args.add_argument('limit', type=inputs.positive, required=False, location='args', help='Maximum number of Customers to return')
+search_args.add_argument('fields', type=str, required=False, location='args', help='Comma separated fields to return, customer_id is always included')
+
+@api.route("/customers/search")
+class SearchResource(Resource):
+    """ Finds Customers by part of their name, email or phone number """
+
+    @api.doc('search_customers')
+    @api.response(200, 'Success', [customer_model])
+    @api.response(400, 'The search term was empty')
+    @api.expect(search_args, validate=True)
+    def get(self):
+        """
+        Search Customers
+        Matches are case insensitive and may be anywhere in a value, Customers whose first name starts with the term come first
+        """
+        args = search_args.parse_args()
+        current_app.logger.info("Request to search Customers for %s", args['q'])
+        limit = min(args['limit'] or current_app.config['SEARCH_LIMIT'], current_app.config['MAX_SEARCH_LIMIT'])
+        fields = requested_fields(args['fields'])
+        rows = Customer.search(args['q'], limit=limit, fields=fields)
+        return json_response(Customer.serialize_rows(rows, fields), status.HTTP_200_OK)
+
+######################################################################
+# PATH: /customers/changes
+######################################################################
+changes_args = reqparse.RequestParser()
+changes_args.add_argument('since', type=str, required=False, location='args', help='The cursor returned by the previous call, leave out to start from the beginning')
+changes_args.add_argument('limit', type=inputs.positive, required=False, location='args', help='Maximum number of changes to return')
+changes_args.add_argument('fields', type=str, required=False, location='args', help='Comma separated fields to return, customer_id is always included')
+
+change_model = api.model('CustomerChange', {
+    'operation': fields.String(enum=['upsert', 'delete'], description='upsert for a created or updated Customer, delete for a deleted one'),
+    'customer': fields.Nested(customer_model, description='The Customer as it is now, only its customer_id once deleted'),
+})
+
+changes_model = api.model('CustomerChanges', {
+    'changes': fields.List(fields.Nested(change_model), description='The changes, oldest first'),
+    'cursor': fields.String(description='Pass as since to get the changes that follow'),
+    'more': fields.Boolean(description='Whether more changes are ready now'),
+})
+
+@api.route("/customers/changes")
+class ChangesResource(Resource):
+    """ Lists the Customers changed since a cursor """
+
+    @api.doc('customer_changes')
+    @api.response(200, 'Success', changes_model)
+    @api.response(400, 'The cursor was not valid')
+    @api.expect(changes_args, validate=True)
+    def get(self):
+        """
+        List changes
+        Returns the Customers created, updated or deleted after the cursor, each at its latest change, oldest first
+        """
+        args = changes_args.parse_args()
+        since = decode_position(args['since']) if args['since'] else (0, 0)
+        current_app.logger.info("Request for Customer changes after %s", since)
+        limit = min(args['limit'] or current_app.config['DEFAULT_PAGE_SIZE'], current_app.config['MAX_PAGE_SIZE'])
+        # fetch one extra change to find out if there are more
+        changes = Customer.changes(since, limit + 1, requested_fields(args['fields']))
+        more = len(changes) > limit
+        changes = changes[:limit]
+        if changes:
+            since = changes[-1][0]
+        cursor = encode_position(since)
+        body = {
+            'changes': [{'operation': operation, 'customer': data} for _, operation, data in changes],
+            'cursor': cursor,
+            'more': more,
+        }
+        return json_response(body, status.HTTP_200_OK, {"X-Next-Cursor": cursor})
+
+######################################################################
+# PATH: /customers/stats
+######################################################################
+stats_model = api.model('CustomerStats', {
+    'total': fields.Integer(description='The number of Customers'),
+    'active': fields.Integer(description='The number of active Customers'),
+    'inactive': fields.Integer(description='The number of inactive Customers'),
+})
+
+@api.route("/customers/stats")
+class StatsResource(Resource):
+    """ Summarizes the Customer table """
+
+    @api.doc('customer_stats')
+    @api.response(200, 'Success', stats_model)
+    def get(self):
+        """
+        Count Customers
+        The totals are kept by the database as Customers are written, so reading them does not scan the table
+        """
+        current_app.logger.info("Request for Customer stats")
+        return json_response(Customer.stats(), status.HTTP_200_OK)
+
+######################################################################
+# PATH: /customers/lookup
+######################################################################
+lookup_args = reqparse.RequestParser()
+lookup_args.add_argument('email', type=str, required=False, location='args', help='Email address in any case')
+lookup_args.add_argument('phone', type=str, required=False, location='args', help='Phone number in any format')
+lookup_args.add_argument('fields', type=str, required=False, location='args', help='Comma separated fields to return, customer_id is always included')
+
+@api.route("/customers/lookup")
+class LookupResource(Resource):
+    """ Finds the Customer with an exact email address or phone number """
+
+    @api.doc('lookup_customer')
+    @api.response(200, 'Success', customer_model)
+    @api.response(400, 'Not exactly one of email and phone was given')
+    @api.response(404, 'No Customer has that email address or phone number')
+    @api.expect(lookup_args, validate=True)
+    def get(self):
+        """
+        Look up a Customer
+        Emails match in any case and phone numbers in any format, when several Customers share one the oldest is returned
+        """
+        args = lookup_args.parse_args()
+        if bool(args['email']) == bool(args['phone']):
+            abort(status.HTTP_400_BAD_REQUEST, "Give exactly one of email and phone.")
+        current_app.logger.info("Request to look up Customer by %s", args['email'] or args['phone'])
+        fields = requested_fields(args['fields'])
+        if args['email']:
+            customer = Customer.find_by_email_key(args['email'])
+        else:
+            customer = Customer.find_by_phone_key(args['phone'])
+        if customer is None:
+            abort(status.HTTP_404_NOT_FOUND, "No Customer has '{}'.".format(args['email'] or args['phone']))
+        headers = {"ETag": customer_etag(customer.version)}
+        return json_response(customer.serialize(fields), status.HTTP_200_OK, headers)
+
+######################################################################
+# PATH: /customers/import
+######################################################################
+# Media types of the files accepted by the import, and how many rejects a response lists
+IMPORT_FORMATS = {"text/csv": "csv", "application/x-ndjson": "ndjson"}
+REPORTED_REJECTS = 100
+
+@api.route("/customers/import")
+class ImportResource(Resource):
+    """ Loads a file of Customers """
+    @api.doc('import_customers')
+    @api.response(200, 'The file was read, see the counts and the rejected rows')
+    @api.response(415, 'The body was neither CSV nor NDJSON')
+    def post(self):
+        """
+        Import Customers
+        The CSV or NDJSON body is streamed into the database in chunks, rows that are not valid are skipped and reported
+        """
+        file_format = IMPORT_FORMATS.get(request.mimetype)
+        if file_format is None:
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be text/csv or application/x-ndjson")
+        current_app.logger.info("Request to import a %s file", file_format)
+        rejects = []
+
+        def reject(number, raw, error):
+            if len(rejects) < REPORTED_REJECTS:
+                rejects.append({'line': number, 'error': error})
+
+        from service.importer import import_customers
+
+        lines = io.TextIOWrapper(request.stream, encoding=request.mimetype_params.get("charset", "utf-8"), newline="")
+        counts = import_customers(
+            db.engine, lines, file_format, chunk_size=current_app.config['IMPORT_CHUNK_SIZE'], reject=reject
+        )
+        current_app.logger.info("Imported %s of %s customers", counts['imported'], counts['read'])
+        if counts['imported']:
+            # the rows went through the engine, not the session that marks writes
+            db.session.info["wrote"] = True
+            customer_cache().clear()
+        return json_response(dict(counts, rejects=rejects), status.HTTP_200_OK)
+
+######################################################################
+# PATH: /customers/export
+######################################################################
+export_args = reqparse.RequestParser()
+export_args.add_argument('format', type=str, required=False, location='args', default='ndjson',
+                         choices=('ndjson', 'csv'), help='Export as newline delimited JSON or CSV')
+
+EXPORT_FIELDS = list(Customer.FIELDS)
+
+@api.route("/customers/export")
+class ExportResource(Resource):
+    """ Streams the whole Customer table """
+    @api.doc('export_customers')
+    @api.expect(export_args, validate=True)
+    def get(self):
+        """
+        Export all Customers
+        This endpoint streams every Customer as NDJSON or CSV without buffering the table
+        """
+        args = export_args.parse_args()
+        current_app.logger.info("Request to export customers as %s", args['format'])
+        customers = Customer.stream(current_app.config['EXPORT_BATCH_SIZE'])
+        if args['format'] == 'csv':
+            body, mimetype = export_csv(customers), "text/csv"
+        else:
+            body, mimetype = export_ndjson(customers), "application/x-ndjson"
+        return Response(
+            stream_with_context(body),
+            status=status.HTTP_200_OK,
+            mimetype=mimetype,
+            headers={"Content-Disposition": "attachment; filename=customers.{}".format(args['format'])},
+        )
+
+
+def export_ndjson(customers):
+    """ Yields one JSON document per line for each Customer """
+    for customer in customers:
+        yield json.dumps(customer.serialize()) + "\n"
 
 
+def export_csv(customers):
+    """ Yields a CSV header followed by one line per Customer """
+    import io
+    import csv
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    yield buffer.getvalue()
+    for customer in customers:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(customer.serialize())
+        yield buffer.getvalue()
 
 
 # @app.route("/customers/<int:customer_id>", methods=["GET"])
@@ -214,7 +676,7 @@ class CustomerCollection(Resource):
 ######################################################################
 # PATH /customers/{user_id}
 ######################################################################
-@api.route('/customers/<customer_id>')
+@api.route('/customers/<int:customer_id>')
 @api.param('customer_id', 'The Customer identifier')
 class CustomerResource(Resource):
     """
@@ -229,15 +691,25 @@ class CustomerResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_customers')
     @api.response(404, 'Customer not found')
-    @api.marshal_with(customer_model)
+    @api.response(200, 'Success', customer_model)
+    @api.response(304, 'The Customer still matches the ETag in If-None-Match')
+    @api.expect(fields_args, validate=True)
     def get(self, customer_id):
         """
         Retrieve a single customer
         This endpoint will return a Customer based on user_id
         """
-        app.logger.info("Request for Customer with id: %s", customer_id)
-        customer = Customer.find_or_404_int(customer_id)
-        return customer.serialize(), status.HTTP_200_OK
+        current_app.logger.info("Request for Customer with id: %s", customer_id)
+        fields = requested_fields(fields_args.parse_args()['fields'])
+        entry = Customer.find_versioned(customer_id, fields)
+        if entry is None:
+            abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(customer_id))
+        version, customer = entry
+        etag = customer_etag(version, fields)
+        headers = {"ETag": etag}
+        if if_none_match(etag):
+            return json_response({}, status.HTTP_304_NOT_MODIFIED, headers)
+        return json_response(customer, status.HTTP_200_OK, headers)
 
     #------------------------------------------------------------------
     # UPDATE AN EXISTING CUSTOMER
@@ -245,6 +717,7 @@ class CustomerResource(Resource):
 
     @api.doc('update_customers')
     @api.response(404, 'Customer not found')
+    @api.response(412, 'The Customer was changed since the ETag in If-Match was read')
     @api.response(400, 'The posted Customer data was not valid')
     @api.expect(customer_model)
     @api.marshal_with(customer_model)
@@ -253,14 +726,15 @@ class CustomerResource(Resource):
         Update a Customer
         This endpoint will update a Customer based the body that is posted
         """
-        app.logger.info("Requesting to update a customer")
+        current_app.logger.info("Requesting to update a customer")
         check_content_type("application/json")
-        customer = Customer.find_or_404_int(customer_id)
-        customer.deserialize(api.payload)
-        customer.customer_id = customer_id
-        customer.update()
-        app.logger.info("Updated customer with id %s", customer.customer_id)
-        return customer.serialize(), status.HTTP_200_OK
+        customer = Customer().deserialize(api.payload)
+        expected_version = if_match_version()
+        row = Customer.update_returning(customer_id, customer.column_values(), expected_version)
+        if row is None:
+            abort_write_failed(customer_id, expected_version)
+        current_app.logger.info("Updated customer with id %s", customer_id)
+        return Customer.serialize_row(row), status.HTTP_200_OK, {"ETag": customer_etag(row["version"])}
     
     #------------------------------------------------------------------
     # DELETE A CUSTOMER
@@ -272,7 +746,7 @@ class CustomerResource(Resource):
         Delete a Customer
         This endpoint will delete a Customer based the id specified in the path
         """
-        app.logger.info("Request to delete customer with id: %s", customer_id)
+        current_app.logger.info("Request to delete customer with id: %s", customer_id)
         customer = Customer.find(customer_id)
         if customer:
             customer.delete()
@@ -325,13 +799,11 @@ class DeactivateResource(Resource):
         Deactivate a Customer
         This endpoint will deactivate a Customer
         """
-        app.logger.info('Request to deactivate customer with id: %s', customer_id)
-        customer = Customer.find(customer_id)
-        if customer == None:
-            app.abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found".format(customer_id))
-        customer.active = False
-        customer.update()
-        return customer.serialize(), status.HTTP_200_OK
+        current_app.logger.info('Request to deactivate customer with id: %s', customer_id)
+        row = Customer.update_returning(customer_id, {"active": False})
+        if row is None:
+            abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found".format(customer_id))
+        return Customer.serialize_row(row), status.HTTP_200_OK, {"ETag": customer_etag(row["version"])}
         
 
 ######################################################################
@@ -347,13 +819,11 @@ class ActivateResource(Resource):
         Activate a Customer
         This endpoint will deactivate a Customer
         """
-        app.logger.info('Request to activate customer with id: %s', customer_id)
-        customer = Customer.find(customer_id)
-        if customer == None:
-            app.abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found".format(customer_id))
-        customer.active = True
-        customer.update()
-        return customer.serialize(), status.HTTP_200_OK
+        current_app.logger.info('Request to activate customer with id: %s', customer_id)
+        row = Customer.update_returning(customer_id, {"active": True})
+        if row is None:
+            abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found".format(customer_id))
+        return Customer.serialize_row(row), status.HTTP_200_OK, {"ETag": customer_etag(row["version"])}
 
 
 ######################################################################
@@ -365,13 +835,134 @@ def check_content_type(media_type):
     content_type = request.headers.get("Content-Type")
     if content_type and content_type == media_type:
         return
-    app.logger.error("Invalid Content-Type: %s", content_type)
+    current_app.logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
         "Content-Type must be {}".format(media_type),
     )
 
+def bulk_selection():
+    """Returns the customer_ids in the body and the filters in the query string"""
+    filters = {key: value for key, value in bulk_args.parse_args().items() if value is not None}
+    customer_ids = None
+    if request.content_length:
+        check_content_type("application/json")
+        payload = request.get_json()
+        if not isinstance(payload, dict):
+            raise DataValidationError("Invalid selection: body of request must be an object")
+        customer_ids = payload.get("customer_ids")
+        if customer_ids is not None and (
+                not isinstance(customer_ids, list)
+                or not all(isinstance(x, int) and not isinstance(x, bool) for x in customer_ids)):
+            raise DataValidationError("Invalid selection: customer_ids must be a list of integers")
+    return customer_ids, filters
+
+
+def batch_error(index, message):
+    """Returns the status of a batch item that was not created"""
+    return {
+        'index': index,
+        'status': status.HTTP_400_BAD_REQUEST,
+        'error': 'Bad Request',
+        'message': message
+    }
+
+
+def requested_fields(value):
+    """Returns the fields selected by a ?fields= value, or None for all of them"""
+    if not value:
+        return None
+    return Customer.select_fields([name.strip() for name in value.split(",") if name.strip()])
+
+
+def customer_etag(version, fields=None):
+    """Returns the ETag header value of a Customer at the given row version
+
+    A ?fields= projection is a different representation, its weak tag
+    names the fields so it never matches the full Customer or another
+    projection, and is never accepted by If-Match.
+    """
+    if fields is None:
+        return quote_etag(str(version))
+    return quote_etag("{};{}".format(version, ",".join(fields)), weak=True)
+
+
+def list_etag(customers, fields=None):
+    """Returns the weak ETag header value of a page, which changes whenever any Customer on it changes
+
+    Like customer_etag() it names the fields of a ?fields= projection.
+    """
+    versions = ",".join("{}.{}".format(x.customer_id, x.version) for x in customers)
+    if fields is not None:
+        versions += ";" + ",".join(fields)
+    return quote_etag(hashlib.md5(versions.encode()).hexdigest(), weak=True)
+
+
+def if_none_match(etag):
+    """Returns whether If-None-Match names the ETag, compared weakly and in any encoding"""
+    etags = request.if_none_match
+    tags = {identity_etag(tag) for tag in etags.as_set(include_weak=True)}
+    return etags.star_tag or unquote_etag(etag)[0] in tags
+
+
+def if_match_version():
+    """Returns the row version required by an If-Match header, or None
+
+    Several tags, or a tag that is not a version, can never match and are
+    mapped to -1 so the conditional write fails with 412.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    tags = request.if_match.as_set()
+    try:
+        return int(identity_etag(tags.pop())) if len(tags) == 1 else -1
+    except ValueError:
+        return -1
+
+
+def abort_write_failed(customer_id, expected_version):
+    """Aborts a write that matched no row with 404 or 412"""
+    if expected_version is not None and Customer.exists(customer_id):
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            "The Customer was changed since it was read",
+        )
+    abort(status.HTTP_404_NOT_FOUND, "Customer with id '{}' was not found.".format(customer_id))
+
+
+def encode_cursor(customer_id):
+    """Encodes a customer_id as an opaque cursor"""
+    return base64.urlsafe_b64encode(str(customer_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor back into a customer_id"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError) as error:
+        raise DataValidationError("Invalid pagination cursor: {}".format(cursor)) from error
+
+
+def encode_position(position):
+    """Encodes a (change_txid, change_seq) position of the change feed as an opaque cursor"""
+    return encode_cursor("{}.{}".format(*position))
+
+
+def decode_position(cursor):
+    """ Decodes a change feed cursor back into a position """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = [int(x) for x in base64.urlsafe_b64decode(padded.encode()).decode().split(".")]
+    except (ValueError, UnicodeDecodeError) as error:
+        raise DataValidationError("Invalid change cursor: {}".format(cursor)) from error
+    if len(values) != 2:
+        raise DataValidationError("Invalid change cursor: {}".format(cursor))
+    return tuple(values)
+
+
 def init_db():
     """ Initialies the SQLAlchemy app """
-    global app
+    from service import app
+
     Customer.init_db(app)
\ No newline at end of file
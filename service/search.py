@@ -0,0 +1,145 @@
+"""
+Module: search
+
+Normalized search text and the indexes that back Customer search
+
+Each Customer stores its names, email and phone number in one lowercase
+search_text column, the phone number reduced to its digits. Searches match
+a lowercase term anywhere in that text:
+
+* Postgres answers with a pg_trgm GIN index on search_text, which serves
+  LIKE '%term%' without scanning the table.
+* SQLite, used locally, keeps an FTS5 trigram table in sync with triggers.
+
+Terms shorter than a trigram fall back to LIKE on SQLite.
+
+The canonical email and phone keys used for exact lookups are normalized
+here as well, so that searches and lookups agree on what a value means.
+"""
+import re
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+# Name of the SQLite full text table that mirrors customer.search_text
+FTS_TABLE = "customer_search"
+
+# A term made only of these characters is looked up as a phone number
+PHONE_PATTERN = re.compile(r"^[\d\s()+.\-]+$")
+
+# A trailing extension such as "x123" or "ext. 123" is not part of the number
+EXTENSION_PATTERN = re.compile(r"\s*(x|ext\.?|extension)\s*\d+\s*$", re.IGNORECASE)
+
+
+def normalize(value):
+    """ Lowercases a value and collapses its whitespace """
+    return " ".join((value or "").lower().split())
+
+
+def digits(value):
+    """ Returns only the digits of a value """
+    return re.sub(r"\D", "", value or "")
+
+
+def search_text(firstname, lastname, email_id, phone_number):
+    """ Returns the search_text column value of a Customer """
+    parts = (normalize(firstname), normalize(lastname), normalize(email_id), digits(phone_number))
+    return " ".join(part for part in parts if part)
+
+
+def search_term(query):
+    """ Normalizes what a user typed the same way as search_text """
+    if PHONE_PATTERN.match(query or "") and digits(query):
+        return digits(query)
+    return normalize(query)
+
+
+######################################################################
+#  L O O K U P   K E Y S
+######################################################################
+def email_key(email_id):
+    """ Returns the canonical form of an email address, or None without one """
+    return "".join((email_id or "").split()).lower() or None
+
+
+def phone_key(phone_number, country_code="1"):
+    """Returns a phone number in E.164 form (+ and digits), or None without one
+
+    Numbers written with a + or the 00 international prefix keep their own
+    country code. Other numbers are national numbers of country_code, whose
+    trunk prefix 0 (or 1 in North America) is dropped when present.
+    """
+    # "+44 (0)20 ..." marks the trunk prefix that is only dialed nationally
+    number = EXTENSION_PATTERN.sub("", phone_number or "").replace("(0)", "").strip()
+    national = digits(number)
+    if not national:
+        return None
+    if number.startswith("+"):
+        return "+" + national
+    if national.startswith("00"):
+        return "+" + national[2:]
+    if country_code == "1" and len(national) == 11 and national.startswith("1"):
+        national = national[1:]
+    elif national.startswith("0"):
+        national = national[1:]
+    return "+" + country_code + national
+
+
+######################################################################
+#  I N D E X E S
+######################################################################
+POSTGRES_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX {concurrently}IF NOT EXISTS ix_customer_search_text_trgm "
+    "ON customer USING gin (search_text gin_trgm_ops)",
+)
+
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+    "search_text, content='customer', content_rowid='customer_id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON customer BEGIN "
+    "INSERT INTO {fts}(rowid, search_text) VALUES (new.customer_id, new.search_text); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON customer BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, search_text) VALUES ('delete', old.customer_id, old.search_text); END",
+    "CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF search_text ON customer BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, search_text) VALUES ('delete', old.customer_id, old.search_text); "
+    "INSERT INTO {fts}(rowid, search_text) VALUES (new.customer_id, new.search_text); END",
+    "INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+)
+
+
+def create_index(connection, concurrently=False):
+    """Creates the search index of the customer table for the connection's database
+
+    Returns False when the database cannot build it, searches then scan.
+    """
+    if connection.dialect.name == "postgresql":
+        statements = [
+            ddl.format(concurrently="CONCURRENTLY " if concurrently else "") for ddl in POSTGRES_DDL
+        ]
+    elif connection.dialect.name == "sqlite":
+        statements = [ddl.format(fts=FTS_TABLE) for ddl in SQLITE_DDL]
+    else:
+        return False
+    try:
+        for statement in statements:
+            connection.execute(text(statement))
+    except OperationalError:
+        # SQLite built without FTS5 or without the trigram tokenizer
+        if connection.dialect.name != "sqlite":
+            raise
+        connection.execute(text("DROP TABLE IF EXISTS {}".format(FTS_TABLE)))
+        return False
+    return True
+
+
+def drop_index(connection):
+    """ Drops the SQLite full text table, the Postgres index goes with its table """
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS {}".format(FTS_TABLE)))
+
+
+def has_fts(connection):
+    """ Tells if the SQLite full text table exists """
+    return connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": FTS_TABLE}
+    ).first() is not None
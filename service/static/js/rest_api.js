@@ -295,36 +295,30 @@ $(function () {
 
         ajax.done(function(res){
             //alert(res.toSource())
-            $("#search_results").empty();
-            $("#search_results").append('<table class="table-striped" cellpadding="10">');
-            var header = '<tr>'
-            header += '<th style="width:10%">ID</th>'
-            header += '<th style="width:40%">FirstName</th>'
-            header += '<th style="width:40%">LastName</th>'
-            header += '<th style="width:40%">Email id</th>'
-            header += '<th style="width:40%">Address</th>'
-            header += '<th style="width:40%">Phone number</th>'
-            header += '<th style="width:40%">Card number</th>'
-            header += '<th style="width:10%">Active</th></tr>'
-            $("#search_results").append(header);
-            var firstCustomer = "";
-            for(var i = 0; i < res.length; i++) {
-                var customer = res[i];
-                var row = "<tr><td>"+customer.customer_id+"</td><td>"+customer.firstname+"</td><td>"+customer.lastname+"</td><td>"+customer.address+"</td><td>"+customer.email_id+"</td><td>"+customer.phone_number+"</td><td>"+customer.card_number+"</td><td>"+customer.active+"</td></tr>";
-                $("#search_results").append(row);
-                if (i == 0) {
-                    firstCustomer = customer;
-                }
-            }
+            show_results(res)
+        });
 
-            $("#search_results").append('</table>');
+        ajax.fail(function(res){
+            flash_message(res.responseJSON.message)
+        });
 
-            // copy the first result to the form
-            if (firstCustomer != "") {
-                update_form_data(firstCustomer)
-            }
+    });
 
-            flash_message("Success")
+    // ****************************************
+    // Quick Search by part of a name, email or phone number
+    // ****************************************
+
+    $("#quick-search-btn").click(function () {
+
+        var ajax = $.ajax({
+            type: "GET",
+            url: "/customers/search?q=" + encodeURIComponent($("#quick_search").val()),
+            contentType: "application/json",
+            data: ''
+        })
+
+        ajax.done(function(res){
+            show_results(res)
         });
 
         ajax.fail(function(res){
@@ -333,4 +327,38 @@ $(function () {
 
     });
 
+    // Lists Customers in the results table and copies the first to the form
+    function show_results(res) {
+        $("#search_results").empty();
+        $("#search_results").append('<table class="table-striped" cellpadding="10">');
+        var header = '<tr>'
+        header += '<th style="width:10%">ID</th>'
+        header += '<th style="width:40%">FirstName</th>'
+        header += '<th style="width:40%">LastName</th>'
+        header += '<th style="width:40%">Email id</th>'
+        header += '<th style="width:40%">Address</th>'
+        header += '<th style="width:40%">Phone number</th>'
+        header += '<th style="width:40%">Card number</th>'
+        header += '<th style="width:10%">Active</th></tr>'
+        $("#search_results").append(header);
+        var firstCustomer = "";
+        for(var i = 0; i < res.length; i++) {
+            var customer = res[i];
+            var row = "<tr><td>"+customer.customer_id+"</td><td>"+customer.firstname+"</td><td>"+customer.lastname+"</td><td>"+customer.address+"</td><td>"+customer.email_id+"</td><td>"+customer.phone_number+"</td><td>"+customer.card_number+"</td><td>"+customer.active+"</td></tr>";
+            $("#search_results").append(row);
+            if (i == 0) {
+                firstCustomer = customer;
+            }
+        }
+
+        $("#search_results").append('</table>');
+
+        // copy the first result to the form
+        if (firstCustomer != "") {
+            update_form_data(firstCustomer)
+        }
+
+        flash_message("Success")
+    }
+
 })
@@ -13,7 +13,7 @@ class CustomerFactory(factory.Factory):
     firstname = factory.Faker("first_name")
     lastname = factory.Faker("last_name")
     email_id = factory.Faker("email")
-    address = factory.Faker("address")
+    address = factory.Faker("street_address")
     phone_number = factory.Faker("phone_number")
     card_number = factory.Faker("phone_number")
     active = FuzzyChoice(choices=[True])
\ No newline at end of file
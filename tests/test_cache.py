@@ -0,0 +1,74 @@
+"""
+Test cases for the Customer caches
+
+"""
+import unittest
+from service.cache import LRUCache, NullCache, create_cache
+
+
+class FakeClock:
+    """ A clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the LRU cache """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_hit_and_miss(self):
+        """ Count hits and misses """
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {"customer_id": 1})
+        self.assertEqual(self.cache.get(1), {"customer_id": 1})
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 1, 1))
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the entry that was used least recently """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.get(1)
+        self.cache.set(3, "three")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "one")
+        self.assertEqual(self.cache.get(3), "three")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        """ Expire entries after the TTL """
+        self.cache.set(1, "one")
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get(1), "one")
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_delete_and_clear(self):
+        """ Invalidate one or every entry """
+        self.cache.set(1, "one")
+        self.cache.set(2, "two")
+        self.cache.delete(1)
+        self.cache.delete(5)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+
+    def test_create_cache(self):
+        """ Switch caching off with a size of 0 """
+        self.assertIsInstance(create_cache(0, 5), NullCache)
+        self.assertIsInstance(create_cache(10, 5), LRUCache)
+        cache = create_cache(0, 5)
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["misses"], 1)
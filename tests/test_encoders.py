@@ -0,0 +1,30 @@
+"""
+Test cases for the JSON encoders
+
+"""
+import json
+import unittest
+from unittest.mock import patch
+from service import encoders
+
+
+######################################################################
+#  E N C O D E R   T E S T   C A S E S
+######################################################################
+class TestEncoders(unittest.TestCase):
+    """ Test Cases for encoding response bodies """
+
+    def test_dumps(self):
+        """ Encode rows as compact JSON bytes """
+        rows = [{"customer_id": 1, "firstname": "Zoë", "card_number": None, "active": True}]
+        data = encoders.dumps(rows)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data), rows)
+        self.assertNotIn(b", ", data)
+
+    def test_dumps_without_orjson(self):
+        """ Encode with the json module when orjson is not installed """
+        rows = [{"customer_id": 1, "firstname": "Zoë", "active": False}]
+        with patch.object(encoders, "orjson", None):
+            data = encoders.dumps(rows)
+        self.assertEqual(data, encoders.dumps(rows))
@@ -9,8 +9,8 @@ import json
 
 
 from werkzeug.exceptions import NotFound
-from service.models import Customer, DataValidationError, db
-from service import app
+from service.models import Customer, DataValidationError, db, dispose_engines
+from service import app, counts
 from .factories import CustomerFactory
 from flask import jsonify
 
@@ -210,6 +210,21 @@ class TestCustomer(unittest.TestCase):
         self.assertEqual(customers[0].card_number,"489372893")
         self.assertEqual(customers[0].active,True)
 
+    def test_find_by_lookup_keys(self):
+        """ Find the oldest Customer with an email in any case or a phone number in any format """
+        john = Customer(firstname="John", lastname="Doe", email_id="JD@xyz.com",address="102 Mercer St, Apt 8, NY",phone_number="(555) 010-1234",card_number="489372893",active=True)
+        john.create()
+        Customer(firstname="Jane", lastname="Doe", email_id="jd@XYZ.com",address="102 XYZ St, Apt 98, Tx",phone_number="555.010.1234",card_number="48097572893",active=True).create()
+        self.assertEqual(john.email_key, "jd@xyz.com")
+        self.assertEqual(john.phone_key, "+15550101234")
+        self.assertEqual(Customer.find_by_email_key(" jd@xyz.COM").customer_id, john.customer_id)
+        self.assertEqual(Customer.find_by_phone_key("+1 555 010 1234").customer_id, john.customer_id)
+        self.assertIsNone(Customer.find_by_email_key("nobody@xyz.com"))
+        self.assertIsNone(Customer.find_by_phone_key(""))
+        john.email_id = "john@xyz.com"
+        john.update()
+        self.assertEqual(Customer.find_by_email_key("jd@xyz.com").firstname, "Jane")
+
     def test_find_or_404_found(self):
         """ Find or return 404 found """
         customers = CustomerFactory.create_batch(3)
@@ -313,3 +328,211 @@ class TestCustomer(unittest.TestCase):
         print(result)
         self.assertEqual(len(Customer.find_by_boolean(True)), 2)
         self.assertEqual(len(Customer.find_by_boolean(False)), 1)
+
+    def test_paginate(self):
+        """Test keyset pagination over customer_id"""
+        customers = CustomerFactory.create_batch(5)
+        for customer in customers:
+            customer.create()
+        ids = [customer.customer_id for customer in customers]
+        page = Customer.paginate(2)
+        self.assertEqual([x.customer_id for x in page], ids[:2])
+        page = Customer.paginate(2, after=page[-1].customer_id)
+        self.assertEqual([x.customer_id for x in page], ids[2:4])
+        page = Customer.paginate(2, after=page[-1].customer_id)
+        self.assertEqual([x.customer_id for x in page], ids[4:])
+
+    def test_stream(self):
+        """Test streaming every customer in batches"""
+        customers = CustomerFactory.create_batch(5)
+        for customer in customers:
+            customer.create()
+        streamed = list(Customer.stream(batch_size=2))
+        self.assertEqual([x.customer_id for x in streamed], [x.customer_id for x in customers])
+
+    def test_create_many(self):
+        """Test creating many customers in one transaction"""
+        customers = CustomerFactory.create_batch(5)
+        customer_ids = Customer.create_many(customers, chunk_size=2)
+        self.assertEqual(len(customer_ids), 5)
+        self.assertEqual(len(Customer.all()), 5)
+        for customer_id, customer in zip(customer_ids, customers):
+            self.assertEqual(Customer.find(customer_id).email_id, customer.email_id)
+
+    def test_set_active(self):
+        """Test flipping the active status of many customers"""
+        customers = CustomerFactory.create_batch(4)
+        customer_ids = Customer.create_many(customers)
+        self.assertEqual(Customer.set_active(False, customer_ids=customer_ids[:3], chunk_size=2), 3)
+        self.assertEqual(len(Customer.find_by_boolean(False)), 3)
+        self.assertEqual(Customer.set_active(False, customer_ids=customer_ids), 1)
+        self.assertEqual(Customer.set_active(True, filters={"active": False}), 4)
+        self.assertRaises(DataValidationError, Customer.set_active, True)
+        self.assertRaises(DataValidationError, Customer.set_active, True, filters={"address": "x"})
+
+    def test_delete_many(self):
+        """Test deleting many customers with set based statements"""
+        customers = CustomerFactory.create_batch(4)
+        customers[3].lastname = "Purge"
+        customer_ids = Customer.create_many(customers)
+        self.assertEqual(Customer.delete_many(customer_ids=customer_ids[:2]), 2)
+        self.assertEqual(Customer.delete_many(filters={"lastname": "Purge"}), 1)
+        self.assertEqual([x.customer_id for x in Customer.all()], [customer_ids[2]])
+        self.assertRaises(DataValidationError, Customer.delete_many)
+
+    def test_changes(self):
+        """Test that every kind of write moves a Customer to the end of the changes"""
+        customers = CustomerFactory.create_batch(4)
+        customer_ids = Customer.create_many(customers)
+        changes = Customer.changes()
+        self.assertEqual([data["customer_id"] for _, _, data in changes], customer_ids)
+        self.assertEqual({operation for _, operation, _ in changes}, {"upsert"})
+        since = changes[-1][0]
+        self.assertEqual(Customer.changes(since), [])
+        customer = Customer.find(customer_ids[1])
+        customer.lastname = "Changed"
+        customer.update()
+        Customer.set_active(not customers[2].active, customer_ids=[customer_ids[2]])
+        Customer.find(customer_ids[0]).delete()
+        Customer.delete_many(customer_ids=[customer_ids[3]])
+        changes = Customer.changes(since, fields=("customer_id", "lastname"))
+        self.assertEqual(
+            [(operation, data) for _, operation, data in changes],
+            [
+                ("upsert", {"customer_id": customer_ids[1], "lastname": "Changed"}),
+                ("upsert", {"customer_id": customer_ids[2], "lastname": customers[2].lastname}),
+                ("delete", {"customer_id": customer_ids[0]}),
+                ("delete", {"customer_id": customer_ids[3]}),
+            ],
+        )
+        self.assertEqual([x[0] for x in changes], sorted(x[0] for x in changes))
+        self.assertEqual(len(Customer.changes(since, limit=3)), 3)
+
+    @unittest.skipUnless(DATABASE_URI.startswith("postgres"), "positions carry a transaction on Postgres only")
+    def test_changes_wait_for_open_transactions(self):
+        """Test that the changes stop before a write that is still to commit"""
+        first = CustomerFactory()
+        first.create()
+        first_id = first.customer_id
+        db.session.remove()
+        slow = db.engine.connect()
+        try:
+            transaction = slow.begin()
+            slow.execute(Customer.__table__.insert().values(firstname="Slow", lastname="Writer", active=True))
+            later = CustomerFactory()
+            later_name = later.firstname
+            later.create()
+            db.session.remove()
+            self.assertEqual([data["customer_id"] for _, _, data in Customer.changes()], [first_id])
+            transaction.commit()
+        finally:
+            slow.close()
+        db.session.remove()
+        changes = Customer.changes(Customer.changes()[0][0])
+        self.assertEqual([data["firstname"] for _, _, data in changes], ["Slow", later_name])
+
+    def test_count(self):
+        """Test that the counts follow every kind of write"""
+        self.assertEqual(Customer.stats(), {"total": 0, "active": 0, "inactive": 0})
+        customers = CustomerFactory.create_batch(4)
+        for customer in customers:
+            customer.active = True
+        customers[0].lastname = "Counted"
+        customer_ids = Customer.create_many(customers)
+        Customer.set_active(False, customer_ids=customer_ids[:2])
+        customer = Customer.find(customer_ids[2])
+        customer.active = False
+        customer.update()
+        Customer.find(customer_ids[3]).delete()
+        self.assertEqual(Customer.stats(), {"total": 3, "active": 0, "inactive": 3})
+        self.assertEqual(Customer.count({"active": False}), 3)
+        self.assertEqual(Customer.count({"lastname": ["Counted"], "active": False}), 1)
+        Customer.remove_all()
+        self.assertEqual(Customer.count(), 0)
+
+    def test_recount(self):
+        """Test that a recount repairs drifted counts and totals add up the shards"""
+        for active in (True, True, True, False, False):
+            customer = CustomerFactory(active=active)
+            customer.create()
+        db.session.remove()
+        table = counts.customer_counts
+        with db.engine.connect() as connection:
+            connection.execute(table.update().values(total=99))
+            counts.refresh(connection)
+        self.assertEqual(counts.totals(db.session), {True: 3, False: 2})
+        db.session.remove()
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.shard > 0))
+            connection.execute(table.insert(), [
+                {"active": False, "shard": 1, "total": 4},
+                {"active": False, "shard": 2, "total": -1},
+            ])
+        self.assertEqual(Customer.stats(), {"total": 8, "active": 3, "inactive": 5})
+
+    def test_find_by_criteria(self):
+        """Test combining criteria into one query"""
+        Customer(firstname="John", lastname="Doe", email_id="jd@xyz.com",address="102 Mercer St, Apt 8, NY",phone_number="200987634",card_number="489372893",active=True).create()
+        Customer(firstname="Jane", lastname="Doe", email_id="jnd@xyz.com",address="102 XYZ St, Apt 98, Tx",phone_number="200988884",card_number="48097572893",active=False).create()
+        Customer(firstname="Jo_e", lastname="Roe", email_id="jr@xyz.com",address="1 Main St",phone_number="200911111",card_number="48097572000",active=True).create()
+        names = lambda criteria: [x.firstname for x in Customer.find_by_criteria(criteria).order_by(Customer.customer_id)]
+        self.assertEqual(names({"lastname": "Doe", "active": True}), ["John"])
+        self.assertEqual(names({"lastname": "Doe", "active": False}), ["Jane"])
+        self.assertEqual(names({"firstname": ["Jane", "Jo_e"]}), ["Jane", "Jo_e"])
+        self.assertEqual(names({"firstname": "J*", "email_id": None}), ["John", "Jane", "Jo_e"])
+        self.assertEqual(names({"firstname": "Jo_*"}), ["Jo_e"])
+        self.assertEqual(names({"phone_number": ["2009888*", "200911111"]}), ["Jane", "Jo_e"])
+        self.assertRaises(DataValidationError, Customer.find_by_criteria, {"address": "1 Main St"})
+
+    def test_version_increments_on_write(self):
+        """Test that every write bumps the row version"""
+        customer = CustomerFactory()
+        customer.create()
+        self.assertEqual(customer.version, 1)
+        customer.lastname = "Changed"
+        customer.update()
+        self.assertEqual(Customer.find(customer.customer_id).version, 2)
+        Customer.set_active(False, customer_ids=[customer.customer_id])
+        db.session.expire_all()
+        self.assertEqual(Customer.find(customer.customer_id).version, 3)
+        self.assertEqual(Customer.find_versioned(customer.customer_id)[0], 3)
+
+    def test_create_returning(self):
+        """Test creating a customer and getting the stored row back"""
+        customer = CustomerFactory()
+        row = customer.create_returning()
+        self.assertIsNotNone(row["customer_id"])
+        self.assertEqual(row["version"], 1)
+        self.assertEqual(Customer.serialize_row(row)["email_id"], customer.email_id)
+        self.assertEqual(Customer.find(row["customer_id"]).email_id, customer.email_id)
+
+    def test_update_returning(self):
+        """Test updating a customer and getting the stored row back"""
+        row = CustomerFactory().create_returning()
+        customer_id = row["customer_id"]
+        row = Customer.update_returning(customer_id, {"lastname": "Returned"})
+        self.assertEqual((row["lastname"], row["version"]), ("Returned", 2))
+        self.assertIsNone(Customer.update_returning(customer_id, {"active": False}, expected_version=1))
+        row = Customer.update_returning(customer_id, {"active": False}, expected_version=2)
+        self.assertEqual((row["active"], row["version"]), (False, 3))
+        self.assertIsNone(Customer.update_returning(0, {"active": False}))
+        self.assertTrue(Customer.exists(customer_id))
+        self.assertFalse(Customer.exists(0))
+
+    def test_dispose_engines(self):
+        """Test that a disposed engine reconnects on its next use"""
+        CustomerFactory().create()
+        db.session.remove()
+        dispose_engines(app)
+        self.assertEqual(len(Customer.all()), 1)
+
+    def test_select_fields(self):
+        """Test selecting the fields of a sparse Customer"""
+        self.assertEqual(Customer.select_fields(["active", "email_id"]), ("customer_id", "email_id", "active"))
+        self.assertEqual(Customer.select_fields([]), ("customer_id",))
+        self.assertRaises(DataValidationError, Customer.select_fields, ["version"])
+        customer = CustomerFactory()
+        customer.create()
+        db.session.expire_all()
+        version, data = Customer.find_versioned(customer.customer_id, ("customer_id", "lastname"))
+        self.assertEqual(data, {"customer_id": customer.customer_id, "lastname": customer.lastname})
@@ -0,0 +1,49 @@
+"""
+Test cases for the timed connection pool
+
+"""
+import unittest
+from sqlalchemy import create_engine, exc
+from service.pool import Histogram, TimedQueuePool, pool_stats
+
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+class TestTimedQueuePool(unittest.TestCase):
+    """ Test Cases for the pool statistics """
+
+    def setUp(self):
+        self.engine = create_engine(
+            "sqlite://", poolclass=TimedQueuePool, pool_size=2, max_overflow=0, pool_timeout=0.05
+        )
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_histogram(self):
+        """ Count values into cumulative buckets """
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["buckets"], {"0.1": 1, "1.0": 3, "+Inf": 4})
+        self.assertEqual(snapshot["count"], 4)
+        self.assertAlmostEqual(snapshot["sum"], 6.05)
+
+    def test_pool_stats(self):
+        """ Report checked out connections and checkout waits """
+        first = self.engine.connect()
+        second = self.engine.connect()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats["pool"], "TimedQueuePool")
+        self.assertEqual((stats["size"], stats["checked_out"], stats["overflow"]), (2, 2, 0))
+        self.assertEqual(stats["max_overflow"], 0)
+        self.assertRaises(exc.TimeoutError, self.engine.connect)
+        first.close()
+        second.close()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats["checked_out"], 0)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["wait_seconds"]["count"], 3)
+        self.assertGreaterEqual(stats["wait_seconds"]["sum"], 0.05)
@@ -6,6 +6,8 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import io
+import csv
 import logging
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
@@ -17,9 +19,12 @@ from urllib.parse import quote_plus
 from flask.json import jsonify
 from werkzeug import test
 from werkzeug.datastructures import ContentRange
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from service import status  # HTTP Status Codes
-from service.models import Customer, db
-from service.routes import app, init_db
+from service.models import Customer, customer_cache, db
+from service import app, create_app
+from service.routes import encode_cursor, init_db
 from .factories import CustomerFactory
 
 # Disable all but ciritcal errors during normal test run
@@ -350,3 +355,528 @@ class TestCustomerServer(TestCase):
 
         
         
+
+    def test_list_customers_paginated(self):
+        """ List Customers one page at a time """
+        customers = self._create_customers(5)
+        resp = self.app.get("{}?limit=2".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([x["customer_id"] for x in data], [x.customer_id for x in customers[:2]])
+        self.assertIn('rel="next"', resp.headers["Link"])
+        seen = list(data)
+        cursor = resp.headers["X-Next-Cursor"]
+        while cursor:
+            resp = self.app.get("{}?limit=2&after={}".format(BASE_URL, cursor))
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(resp.get_json())
+            cursor = resp.headers.get("X-Next-Cursor")
+        self.assertEqual([x["customer_id"] for x in seen], [x.customer_id for x in customers])
+        self.assertNotIn("Link", resp.headers)
+
+    def test_list_customers_bad_cursor(self):
+        """ List Customers with a cursor that cannot be decoded """
+        resp = self.app.get("{}?after=not-a-cursor".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_ndjson(self):
+        """ Export all Customers as newline delimited JSON """
+        customers = self._create_customers(3)
+        resp = self.app.get("{}/export".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([x["customer_id"] for x in rows], [x.customer_id for x in customers])
+        self.assertEqual(rows[0]["email_id"], customers[0].email_id)
+
+    def test_export_csv(self):
+        """ Export all Customers as CSV """
+        customers = self._create_customers(2)
+        resp = self.app.get("{}/export?format=csv".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        rows = list(csv.reader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(rows[0][:3], ["customer_id", "firstname", "lastname"])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][0], str(customers[0].customer_id))
+        self.assertEqual(rows[1][4], customers[0].address)
+
+    def test_export_bad_format(self):
+        """ Export Customers in an unsupported format """
+        resp = self.app.get("{}/export?format=xml".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_customers_batch(self):
+        """ Create a batch of Customers in one request """
+        payload = [CustomerFactory().serialize() for _ in range(3)]
+        resp = self.app.post("{}/batch".format(BASE_URL), json=payload, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        results = resp.get_json()
+        self.assertEqual([x["status"] for x in results], [201, 201, 201])
+        for result, data in zip(results, payload):
+            resp = self.app.get("{}/{}".format(BASE_URL, result["customer_id"]))
+            self.assertEqual(resp.get_json()["email_id"], data["email_id"])
+
+    def test_create_customers_batch_partial(self):
+        """ Create a batch of Customers where some are not valid """
+        payload = [CustomerFactory().serialize(), {"firstname": "Bad"}, CustomerFactory().serialize()]
+        resp = self.app.post("{}/batch".format(BASE_URL), json=payload, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()
+        self.assertEqual([x["status"] for x in results], [201, 400, 201])
+        self.assertIn("missing", results[1]["message"])
+        self.assertEqual(len(Customer.all()), 2)
+
+    def test_create_customers_batch_column_limits(self):
+        """ Create a batch of Customers that the table could not store """
+        payload = [CustomerFactory().serialize() for _ in range(3)]
+        payload[0]["active"] = None
+        payload[2]["lastname"] = "x" * 64
+        resp = self.app.post("{}/batch".format(BASE_URL), json=payload, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()
+        self.assertEqual([x["status"] for x in results], [400, 201, 400])
+        self.assertIn("active", results[0]["message"])
+        self.assertIn("lastname", results[2]["message"])
+        self.assertEqual(len(Customer.all()), 1)
+        # nothing valid at all
+        resp = self.app.post("{}/batch".format(BASE_URL), json=[payload[0], payload[2]], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([x["index"] for x in resp.get_json()], [0, 1])
+
+    def test_create_customers_batch_database_error(self):
+        """ Create a batch of Customers that the database rejects """
+        payload = [CustomerFactory().serialize() for _ in range(2)]
+        error = IntegrityError("INSERT", {}, Exception("constraint failed"))
+        with patch.object(Customer, "create_many", side_effect=error):
+            resp = self.app.post("{}/batch".format(BASE_URL), json=payload, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        results = resp.get_json()
+        self.assertEqual([(x["index"], x["status"]) for x in results], [(0, 400), (1, 400)])
+        self.assertIn("constraint failed", results[0]["message"])
+        self.assertEqual(len(Customer.all()), 0)
+
+    def test_create_customers_batch_not_a_list(self):
+        """ Create a batch of Customers with a body that is not a list """
+        resp = self.app.post("{}/batch".format(BASE_URL), json={}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_deactivate_by_ids(self):
+        """ Deactivate many Customers by id """
+        customers = self._create_customers(3)
+        ids = [customers[0].customer_id, customers[2].customer_id]
+        resp = self.app.put("{}/deactivate".format(BASE_URL), json={"customer_ids": ids},
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["updated"], 2)
+        inactive = Customer.find_by_boolean(False)
+        self.assertEqual(sorted(x.customer_id for x in inactive), sorted(ids))
+
+    def test_bulk_activate_by_filter(self):
+        """ Activate many Customers by a filter """
+        customers = self._create_customers(2)
+        resp = self.app.put("{}/deactivate?lastname={}".format(BASE_URL, quote_plus(customers[0].lastname)))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(resp.get_json()["updated"], 1)
+        resp = self.app.put("{}/activate?lastname={}".format(BASE_URL, quote_plus(customers[0].lastname)))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["updated"], 1)
+        # activating again changes nothing
+        resp = self.app.put("{}/activate?lastname={}".format(BASE_URL, quote_plus(customers[0].lastname)))
+        self.assertEqual(resp.get_json()["updated"], 0)
+
+    def test_bulk_deactivate_by_prefix(self):
+        """ Deactivate the Customers matching a prefix only when confirmed """
+        for lastname in ("Doe", "Dorsey", "Smith"):
+            CustomerFactory(lastname=lastname, active=True).create()
+        for query in ("lastname=*", "lastname=Do*"):
+            resp = self.app.put("{}/deactivate?{}".format(BASE_URL, query))
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+        self.assertEqual(Customer.find_by_boolean(False), [])
+        resp = self.app.put("{}/deactivate?lastname=Do*&confirm=true".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["updated"], 2)
+        # exact filters need no confirm
+        resp = self.app.put("{}/activate?lastname=Doe".format(BASE_URL))
+        self.assertEqual(resp.get_json()["updated"], 1)
+        resp = self.app.put("{}/activate?lastname=*&confirm=true".format(BASE_URL))
+        self.assertEqual(resp.get_json()["updated"], 1)
+
+    def test_bulk_activate_without_selection(self):
+        """ Activate many Customers without saying which """
+        self._create_customers(1)
+        resp = self.app.put("{}/activate".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("{}/activate".format(BASE_URL), json={"customer_ids": "1"},
+                            content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_delete_by_ids(self):
+        """ Delete many Customers by id """
+        customers = self._create_customers(3)
+        ids = [customers[0].customer_id, customers[1].customer_id]
+        resp = self.app.delete(BASE_URL, json={"customer_ids": ids}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["deleted"], 2)
+        remaining = Customer.all()
+        self.assertEqual([x.customer_id for x in remaining], [customers[2].customer_id])
+
+    def test_bulk_delete_all(self):
+        """ Delete every Customer only when confirmed """
+        self._create_customers(3)
+        resp = self.app.delete(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(Customer.all()), 3)
+        resp = self.app.delete("{}?confirm=true".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["deleted"], 3)
+        self.assertEqual(len(Customer.all()), 0)
+
+    def test_bulk_delete_by_prefix(self):
+        """ Delete the Customers matching a prefix only when confirmed """
+        for firstname in ("John", "Jane", "Joe", "Bob", "Ann"):
+            CustomerFactory(firstname=firstname).create()
+        for query in ("firstname=*", "firstname=Jo*", "lastname=*"):
+            resp = self.app.delete("{}?{}".format(BASE_URL, query))
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+            self.assertIn("confirm=true", resp.get_json()["message"])
+        self.assertEqual(len(Customer.all()), 5)
+        resp = self.app.delete("{}?firstname=Jo*&confirm=true".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["deleted"], 2)
+        self.assertEqual(sorted(x.firstname for x in Customer.all()), ["Ann", "Bob", "Jane"])
+
+    def test_list_with_combined_filters(self):
+        """ List Customers matching every query filter """
+        for firstname, active in (("John", True), ("Jane", False), ("Joe", True), ("Bob", True)):
+            customer = CustomerFactory(firstname=firstname, lastname="Doe", active=active)
+            resp = self.app.post(BASE_URL, json=customer.serialize(), content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get("{}?lastname=Doe&active=false".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([x["firstname"] for x in resp.get_json()], ["Jane"])
+        resp = self.app.get("{}?firstname=Jo*&active=true".format(BASE_URL))
+        self.assertEqual([x["firstname"] for x in resp.get_json()], ["John", "Joe"])
+        resp = self.app.get("{}?firstname=Bob&firstname=Jane".format(BASE_URL))
+        self.assertEqual([x["firstname"] for x in resp.get_json()], ["Jane", "Bob"])
+
+    def test_list_filters_carry_into_next_page(self):
+        """ List filtered Customers one page at a time """
+        for active in (True, False, True, False, True):
+            customer = CustomerFactory(active=active)
+            self.app.post(BASE_URL, json=customer.serialize(), content_type=CONTENT_TYPE_JSON)
+        resp = self.app.get("{}?active=true&limit=2".format(BASE_URL))
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.app.get(resp.headers["Link"].split(";")[0].strip("<>"))
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertTrue(data[0]["active"])
+
+    def test_get_customer_is_cached(self):
+        """ Read a Customer through the cache and invalidate it on writes """
+        test_customer = self._create_customers(1)[0]
+        url = "{}/{}".format(BASE_URL, test_customer.customer_id)
+        before = self.app.get("/stats/cache").get_json()
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+        after = self.app.get("/stats/cache").get_json()
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 1)
+        # every kind of write must be visible on the next read
+        self.app.put("{}/deactivate".format(url))
+        self.assertFalse(self.app.get(url).get_json()["active"])
+        self.app.put("{}/activate".format(BASE_URL), json={"customer_ids": [test_customer.customer_id]},
+                     content_type=CONTENT_TYPE_JSON)
+        self.assertTrue(self.app.get(url).get_json()["active"])
+        data = self.app.get(url).get_json()
+        data["lastname"] = "Cached"
+        self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(self.app.get(url).get_json()["lastname"], "Cached")
+        self.app.delete(url)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_customer_etag(self):
+        """ Get a Customer conditionally with its ETag """
+        test_customer = self._create_customers(1)[0]
+        url = "{}/{}".format(BASE_URL, test_customer.customer_id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        self.app.put("{}/deactivate".format(url))
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_update_customer_if_match(self):
+        """ Update a Customer only when it was not changed since it was read """
+        test_customer = self._create_customers(1)[0]
+        url = "{}/{}".format(BASE_URL, test_customer.customer_id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        data = resp.get_json()
+        data["lastname"] = "First"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        data["lastname"] = "Second"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get(url).get_json()["lastname"], "First")
+
+    def test_list_customers_etag(self):
+        """ List Customers conditionally with the page ETag """
+        customers = self._create_customers(2)
+        resp = self.app.get(BASE_URL)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # every projection of the page is a representation of its own
+        resp = self.app.get(BASE_URL, query_string={"fields": "active"}, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.app.get(BASE_URL, query_string={"fields": "active"},
+                            headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.put("{}/{}/deactivate".format(BASE_URL, customers[1].customer_id))
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_create_customer_single_statement(self):
+        """ Create a Customer without reading it back """
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            resp = self.app.post(BASE_URL, json=CustomerFactory().serialize(), content_type=CONTENT_TYPE_JSON)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("INSERT"))
+
+    def test_update_customer_not_found(self):
+        """ Update and activate a Customer that does not exist """
+        resp = self.app.put("{}/0".format(BASE_URL), json=CustomerFactory().serialize(), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put("{}/0/activate".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.put("{}/0/deactivate".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_pool_stats(self):
+        """ Get the statistics of the connection pool """
+        resp = self.app.get("/stats/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertIn("pool", data)
+
+    def test_create_app_without_database(self):
+        """ Build an app and serve it while its database is unreachable """
+        unreachable = create_app()
+        unreachable.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:////nonexistent/customers.db"
+        resp = unreachable.test_client().get(BASE_URL)
+        # every app keeps its own cache
+        self.assertIsNot(unreachable.extensions["customer_cache"], app.extensions["customer_cache"])
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertIn("customers", unreachable.blueprints)
+
+    def test_list_customers_matches_serialize(self):
+        """ List Customers with the same fields as a single Customer """
+        customers = self._create_customers(2)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, CONTENT_TYPE_JSON)
+        self.assertEqual(resp.get_json(), [Customer.find(x.customer_id).serialize() for x in customers])
+
+    def test_list_customers_sparse_fields(self):
+        """ List Customers with only the requested fields """
+        customers = self._create_customers(3)
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            resp = self.app.get("{}?fields=active,email_id&limit=2".format(BASE_URL))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            resp.get_json(),
+            [{"customer_id": x.customer_id, "email_id": x.email_id, "active": x.active} for x in customers[:2]],
+        )
+        self.assertNotIn("address", statements[-1])
+        self.assertIn("fields=active", resp.headers["Link"])
+        resp = self.app.get("{}?fields=address,secret".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_customer_sparse_fields(self):
+        """ Get a Customer with only the requested fields """
+        customer = self._create_customers(1)[0]
+        db.session.remove()
+        customer_cache().clear()
+        url = "{}/{}?fields=email_id".format(BASE_URL, customer.customer_id)
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            resp = self.app.get(url)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"customer_id": customer.customer_id, "email_id": customer.email_id})
+        self.assertNotIn("address", statements[-1])
+        # a full read fills the cache, which then also answers sparse reads
+        etag = self.app.get("{}/{}".format(BASE_URL, customer.customer_id)).headers["ETag"]
+        resp = self.app.get(url)
+        self.assertEqual(resp.get_json(), {"customer_id": customer.customer_id, "email_id": customer.email_id})
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertTrue(resp.headers["ETag"].startswith("W/"))
+        # the full representation and the projection never stand in for each other
+        self.assertEqual(self.app.get(url, headers={"If-None-Match": etag}).status_code, status.HTTP_200_OK)
+        resp = self.app.get(url, headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get("{}/{}".format(BASE_URL, customer.customer_id), headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("{}/{}?fields=password".format(BASE_URL, customer.customer_id))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_customers(self):
+        """ Search Customers by part of their name, email or phone number """
+        for firstname, lastname, email_id, phone_number in (
+            ("Anna", "Smithson", "anna@xyz.com", "555-010-1111"),
+            ("John", "Smith", "js@xyz.com", "555 010 2222"),
+            ("Smitty", "Jones", "smitty@xyz.com", "555 010 3333"),
+            ("Bob", "Goldsmith", "bob_100%@xyz.com", "(555) 010-4444"),
+        ):
+            customer = CustomerFactory(firstname=firstname, lastname=lastname, email_id=email_id, phone_number=phone_number)
+            resp = self.app.post(BASE_URL, json=customer.serialize(), content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        def names(query):
+            resp = self.app.get("{}/search".format(BASE_URL), query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            return [x["firstname"] for x in resp.get_json()]
+
+        # first names starting with the term, then other words, then anywhere
+        self.assertEqual(names({"q": "SMIT"}), ["Smitty", "Anna", "John", "Bob"])
+        self.assertEqual(names({"q": "smit", "limit": 2}), ["Smitty", "Anna"])
+        self.assertEqual(names({"q": "010-22"}), ["John"])
+        self.assertEqual(names({"q": "0%"}), ["Bob"])
+        self.assertEqual(names({"q": "00%@"}), ["Bob"])
+        self.assertEqual(names({"q": "J"}), ["John", "Smitty"])
+        self.assertEqual(names({"q": "nobody"}), [])
+        resp = self.app.get("{}/search".format(BASE_URL), query_string={"q": "jones", "fields": "email_id"})
+        self.assertEqual(resp.get_json()[0]["email_id"], "smitty@xyz.com")
+        self.assertEqual(set(resp.get_json()[0]), {"customer_id", "email_id"})
+        resp = self.app.get("{}/search".format(BASE_URL), query_string={"q": " "})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_customers(self):
+        """ Import a CSV or NDJSON file of Customers """
+        body = "firstname,lastname,email_id,address,phone_number,card_number,active\n" \
+               "John,Doe,jd@xyz.com,1 Main St,200987634,,true\n" \
+               "Jane,Doe,jnd@xyz.com,1 Main St,200988884,,sometimes\n"
+        resp = self.app.post("{}/import".format(BASE_URL), data=body, content_type="text/csv")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual((data["read"], data["imported"], data["rejected"]), (2, 1, 1))
+        self.assertEqual(data["rejects"][0]["line"], 3)
+        body = json.dumps(CustomerFactory().serialize()) + "\n"
+        resp = self.app.post("{}/import".format(BASE_URL), data=body, content_type="application/x-ndjson")
+        self.assertEqual(resp.get_json()["imported"], 1)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 2)
+        resp = self.app.post("{}/import".format(BASE_URL), data=body, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_customer_changes(self):
+        """ Follow the Customer changes with a cursor """
+        customers = self._create_customers(3)
+        resp = self.app.get("{}/changes".format(BASE_URL), query_string={"limit": 2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([x["customer"]["customer_id"] for x in data["changes"]], [x.customer_id for x in customers[:2]])
+        self.assertTrue(data["more"])
+        resp = self.app.get("{}/changes".format(BASE_URL), query_string={"since": data["cursor"]})
+        data = resp.get_json()
+        self.assertEqual(data["changes"], [{"operation": "upsert", "customer": customers[2].serialize()}])
+        self.assertFalse(data["more"])
+        cursor = data["cursor"]
+        resp = self.app.get("{}/changes".format(BASE_URL), query_string={"since": cursor})
+        self.assertEqual(resp.get_json(), {"changes": [], "cursor": cursor, "more": False})
+        self.app.put("{}/{}/deactivate".format(BASE_URL, customers[1].customer_id))
+        self.app.delete("{}/{}".format(BASE_URL, customers[0].customer_id))
+        resp = self.app.get("{}/changes".format(BASE_URL), query_string={"since": cursor, "fields": "active"})
+        self.assertEqual(resp.get_json()["changes"], [
+            {"operation": "upsert", "customer": {"customer_id": customers[1].customer_id, "active": False}},
+            {"operation": "delete", "customer": {"customer_id": customers[0].customer_id}},
+        ])
+        self.assertEqual(resp.headers["X-Next-Cursor"], resp.get_json()["cursor"])
+        resp = self.app.get("{}/changes".format(BASE_URL), query_string={"since": "not a cursor"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # a cursor of the customer list is not a position
+        resp = self.app.get("{}/changes".format(BASE_URL), query_string={"since": encode_cursor(0)})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_count_customers(self):
+        """ Count Customers with HEAD, X-Total-Count and the stats """
+        customers = self._create_customers(5)
+        inactive = sum(1 for customer in customers if not customer.active)
+        resp = self.app.head(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Total-Count"], "5")
+        self.assertEqual(resp.data, b"")
+        resp = self.app.head(BASE_URL, query_string={"active": "false"})
+        self.assertEqual(resp.headers["X-Total-Count"], str(inactive))
+        resp = self.app.head(BASE_URL, query_string={"lastname": customers[0].lastname})
+        self.assertEqual(
+            resp.headers["X-Total-Count"], str(sum(1 for x in customers if x.lastname == customers[0].lastname))
+        )
+        resp = self.app.get(BASE_URL, query_string={"limit": 2, "count": "true"})
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertEqual(resp.headers["X-Total-Count"], "5")
+        # a page that did not change is not counted again
+        with patch.object(Customer, "count") as count:
+            resp = self.app.get(BASE_URL, query_string={"limit": 2, "count": "true"},
+                                headers={"If-None-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        count.assert_not_called()
+        resp = self.app.get(BASE_URL, query_string={"limit": 2})
+        self.assertNotIn("X-Total-Count", resp.headers)
+        resp = self.app.get("{}/stats".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"total": 5, "active": 5 - inactive, "inactive": inactive})
+
+    def test_lookup_customer(self):
+        """ Look up a Customer by exact email or phone number """
+        customer = CustomerFactory(email_id="Mary.ONeil@xyz.com", phone_number="(555) 010-9999")
+        resp = self.app.post(BASE_URL, json=customer.serialize(), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        customer_id = resp.get_json()["customer_id"]
+        for query in ({"email": "mary.oneil@XYZ.com"}, {"phone": "+1 555-010-9999"}):
+            resp = self.app.get("{}/lookup".format(BASE_URL), query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["customer_id"], customer_id)
+            self.assertEqual(resp.headers["ETag"], '"1"')
+        resp = self.app.get("{}/lookup".format(BASE_URL), query_string={"email": "mary.oneil@xyz.com", "fields": "email_id"})
+        self.assertEqual(resp.get_json(), {"customer_id": customer_id, "email_id": "Mary.ONeil@xyz.com"})
+        resp = self.app.get("{}/lookup".format(BASE_URL), query_string={"phone": "555 010 0000"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("{}/lookup".format(BASE_URL))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("{}/lookup".format(BASE_URL), query_string={"email": "a@b.com", "phone": "555"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_follows_writes(self):
+        """ Search Customers after they are renamed and deleted """
+        customer = self._create_customers(1)[0]
+        data = customer.serialize()
+        data["lastname"] = "Zebediah"
+        resp = self.app.put("{}/{}".format(BASE_URL, customer.customer_id), json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("{}/search?q=zebed".format(BASE_URL))
+        self.assertEqual([x["customer_id"] for x in resp.get_json()], [customer.customer_id])
+        self.app.delete("{}/{}".format(BASE_URL, customer.customer_id))
+        resp = self.app.get("{}/search?q=zebed".format(BASE_URL))
+        self.assertEqual(resp.get_json(), [])
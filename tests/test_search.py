@@ -0,0 +1,53 @@
+"""
+Test cases for the normalized search text and lookup keys
+
+"""
+import unittest
+from service import search
+
+
+######################################################################
+#  S E A R C H   T E X T   T E S T   C A S E S
+######################################################################
+class TestSearchText(unittest.TestCase):
+    """ Test Cases for normalizing what is searched """
+
+    def test_search_text(self):
+        """ Lowercase names and email and keep only the digits of the phone """
+        self.assertEqual(
+            search.search_text(" Mary  Ann", "O'Neil", "Mary.ONeil@XYZ.com", "+1 (555) 010-9999"),
+            "mary ann o'neil mary.oneil@xyz.com 15550109999",
+        )
+        self.assertEqual(search.search_text("John", None, "", None), "john")
+
+    def test_search_term(self):
+        """ Normalize a term the same way as the text it is matched against """
+        self.assertEqual(search.search_term("  ONeil "), "oneil")
+        self.assertEqual(search.search_term("(555) 010-99"), "55501099")
+        self.assertEqual(search.search_term("john 555"), "john 555")
+        self.assertEqual(search.search_term(" - "), "-")
+        self.assertEqual(search.search_term("   "), "")
+
+
+######################################################################
+#  L O O K U P   K E Y   T E S T   C A S E S
+######################################################################
+class TestLookupKeys(unittest.TestCase):
+    """ Test Cases for the canonical email and phone keys """
+
+    def test_email_key(self):
+        """ Lowercase an email and drop its whitespace """
+        self.assertEqual(search.email_key(" Mary.ONeil@XYZ.com "), "mary.oneil@xyz.com")
+        self.assertIsNone(search.email_key("  "))
+        self.assertIsNone(search.email_key(None))
+
+    def test_phone_key(self):
+        """ Write phone numbers in E.164 form """
+        for number in ("(555) 123-4567", "555.123.4567", "1-555-123-4567", "+1 555 123 4567", "555-123-4567 x89"):
+            self.assertEqual(search.phone_key(number), "+15551234567")
+        self.assertEqual(search.phone_key("+44 (0)20 7946 0018"), "+442079460018")
+        self.assertEqual(search.phone_key("0044 20 7946 0018"), "+442079460018")
+        self.assertEqual(search.phone_key("020 7946 0018", "44"), "+442079460018")
+        self.assertEqual(search.phone_key("200987634"), "+1200987634")
+        self.assertIsNone(search.phone_key("ext. "))
+        self.assertIsNone(search.phone_key(None))